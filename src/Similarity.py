@@ -2,33 +2,52 @@ import itk # itk-elastix
 import numpy as np
 
 from utils import Utils
+from similarityMatrix import SimilarityMatrix
+from referenceSelection import ReferenceSelector
 
 
 class SimilarityAtlas:
     util = Utils()
 
-    def __init__(self):
-        self.imagePaths = self.util.getAllFiles("training-set/training-images")
-        self.fixedImagePath, self.movingImagePaths = self.util.splitFixedFromMoving(self.imagePaths, "1000")
+    def __init__(self, imageFolder="training-set/training-images", fixedSubject=None):
+        # fixedSubject: the image the others are registered to in run (default: the first by name). runFast compares
+        # all images without a fixed one
+        self.imagePaths = self.util.getAllFiles(imageFolder)
+        fixedSubject = fixedSubject or self.util.subjectId(min(self.imagePaths))
+        self.fixedImagePath, self.movingImagePaths = self.util.splitFixedFromMoving(list(self.imagePaths), fixedSubject)
 
-    def run(self):
-        # finds the image with the highest similarity by comparison with the mean sqaure error
+    def run(self, metric="mse", downsample=1, mask=None, numberOfWorkers=None):
+        # finds the image with the highest similarity to all others. Returns its index and the full similarity matrix
         registeredImages = self.registerAllImages()
         fixedImage = self.util.loadImageFrom(self.fixedImagePath)
         registeredImages.append(itk.GetArrayFromImage(fixedImage))
+        candidatePaths = self.movingImagePaths + [self.fixedImagePath]
 
-        vecSimilarities=[]
-        for i,fixed in enumerate(registeredImages):
-            similarityValue=0
-            for j,moving in enumerate(registeredImages):
-                if i!=j: # we do this to not to compute ther MSE of the same image
-                    # Compute MSE
-                    similarityValue+=np.mean((fixed - moving) ** 2)
-            vecSimilarities.append(np.mean(similarityValue))
-
-        nameFixed=np.argmin(vecSimilarities)
-        print(f"The name of the fixed image with the highest similarity is {self.movingImagePaths[nameFixed]}" )
-        return nameFixed
+        similarity = SimilarityMatrix(metric, downsample=downsample, mask=mask, numberOfWorkers=numberOfWorkers)
+        similarityMatrix = similarity.compute(registeredImages)
+        nameFixed = similarity.selectReference(similarityMatrix)
+        print(f"The name of the fixed image with the highest similarity is {candidatePaths[nameFixed]}" )
+        return nameFixed, similarityMatrix
+
+    def runFast(self, levels=2, topK=3, metric="ncc", alignment="centroid"):
+        # screens all images at low resolution without registration and refines only the topK finalists:
+        # each finalist is compared to the other finalists after a full resolution rigid registration,
+        # i.e. topK * (topK - 1) elastix runs instead of one per image. Returns the best path and the screening matrix
+        candidatePaths = self.imagePaths
+        selector = ReferenceSelector(levels, topK, metric, alignment)
+        finalists, screeningMatrix = selector.screen(candidatePaths)
+
+        similarity = SimilarityMatrix(metric)
+        scores = []
+        for referencePath in finalists:
+            others = [path for path in finalists if path != referencePath]
+            images = [itk.GetArrayFromImage(self.util.loadImageFrom(referencePath))]
+            images += [itk.GetArrayFromImage(self.register(referencePath, path)) for path in others]
+            scores.append(similarity.compute(images)[0, 1:].mean() if others else 0)
+
+        bestPath = finalists[int(np.argmin(scores) if metric == "mse" else np.argmax(scores))]
+        print(f"The name of the fixed image with the highest similarity is {bestPath}" )
+        return bestPath, screeningMatrix
 
     def registerAllImages(self):
         # registers all moving images
@@ -0,0 +1,115 @@
+import numpy as np
+
+
+class RunningAccumulator:
+    # folds volumes into running sums one at a time, so only the sums are kept in memory.
+    # dtype sets the accumulation precision, e.g. np.float64 for intensities or np.uint16 for vote counts
+
+    def __init__(self, dtype=np.float64, trackVariance=False):
+        self.dtype = dtype
+        self.trackVariance = trackVariance
+        self.count = 0
+        self.sum = None
+        self.sumOfSquares = None
+        self.voxelCount = None # only allocated once a mask is used
+
+    def add(self, volume, mask=None):
+        # adds a volume. With a mask only the voxels inside the mask contribute
+        self.update(volume, mask, sign=1)
+
+    def subtract(self, volume, mask=None):
+        # removes a volume that was added before
+        self.update(volume, mask, sign=-1)
+
+    def update(self, volume, mask, sign):
+        volume = np.asarray(volume)
+        if self.sum is None:
+            self.allocate(volume.shape)
+        if volume.shape != self.sum.shape:
+            raise ValueError(f"Volume shape {volume.shape} does not match the accumulator shape {self.sum.shape}")
+
+        if mask is not None and self.voxelCount is None:
+            self.voxelCount = np.full(self.sum.shape, self.count, dtype=np.uint32)
+
+        ufunc = np.add if sign > 0 else np.subtract
+        where = True if mask is None else mask
+        ufunc(self.sum, volume, out=self.sum, where=where, casting="unsafe")
+        if self.trackVariance:
+            ufunc(self.sumOfSquares, np.square(volume), out=self.sumOfSquares, where=where, casting="unsafe")
+        if self.voxelCount is not None:
+            voxelUpdate = np.ones(self.sum.shape, dtype=np.uint32) if mask is None else mask
+            ufunc(self.voxelCount, voxelUpdate, out=self.voxelCount, casting="unsafe")
+        self.count += sign
+
+    def allocate(self, shape):
+        self.sum = np.zeros(shape, dtype=self.dtype)
+        if self.trackVariance:
+            self.sumOfSquares = np.zeros(shape, dtype=self.dtype)
+
+    ######################################################
+    ### Outputs ##########################################
+    ######################################################
+
+    def counts(self):
+        # number of volumes that contributed to each voxel
+        if self.voxelCount is None:
+            return np.full(self.sum.shape, self.count, dtype=np.uint32)
+        return self.voxelCount
+
+    def mean(self):
+        # voxel-wise mean, voxels without any contribution are 0
+        counts = self.counts()
+        return np.divide(self.sum, counts, out=np.zeros(self.sum.shape), where=counts > 0)
+
+    def variance(self):
+        # voxel-wise (population) variance
+        if not self.trackVariance:
+            raise ValueError("The accumulator was created without trackVariance")
+        counts = self.counts()
+        meanOfSquares = np.divide(self.sumOfSquares, counts, out=np.zeros(self.sum.shape), where=counts > 0)
+        return np.maximum(meanOfSquares - np.square(self.mean()), 0)
+
+
+class VoteAccumulator:
+    # counts per voxel how often each label was propagated there, from integer label maps (one per subject)
+    # instead of one binary volume per label and subject. Label 0 is the background, labels above
+    # numberOfLabels are counted as background as well
+
+    def __init__(self, numberOfLabels, dtype=np.uint16):
+        self.numberOfLabels = numberOfLabels
+        self.dtype = dtype
+        self.count = 0
+        self.votes = None # (numberOfLabels + 1) x voxels
+        self.voxelIndex = None
+        self.shape = None
+
+    def add(self, labelMap):
+        # one pass over the label map: the label of each voxel selects the row that is incremented
+        labelMap = np.asarray(labelMap)
+        if self.votes is None:
+            self.shape = labelMap.shape
+            self.votes = np.zeros((self.numberOfLabels + 1, labelMap.size), dtype=self.dtype)
+            self.voxelIndex = np.arange(labelMap.size)
+        if labelMap.shape != self.shape:
+            raise ValueError(f"Label map shape {labelMap.shape} does not match the accumulator shape {self.shape}")
+
+        labels = labelMap.ravel()
+        labels = np.where(labels <= self.numberOfLabels, labels, 0)
+        self.votes[labels, self.voxelIndex] += 1 # every voxel appears once, so no votes are lost
+        self.count += 1
+
+    ######################################################
+    ### Outputs ##########################################
+    ######################################################
+
+    def counts(self, label):
+        # number of label maps with label at each voxel
+        return self.votes[label].reshape(self.shape)
+
+    def probability(self, label):
+        # fraction of the label maps with label at each voxel
+        return self.counts(label) / max(self.count, 1)
+
+    def majority(self):
+        # most frequent label per voxel (ties go to the lower label)
+        return np.argmax(self.votes, axis=0).reshape(self.shape).astype(np.uint16)
@@ -1,87 +1,140 @@
-import gc
 import os
 import itk # itk-elastix
 import numpy as np
 import nibabel as nib
-import matplotlib.pyplot as plt
 
 
 
 from utils import Utils
 from registration import Registration
+from scheduler import RegistrationScheduler
+from accumulator import RunningAccumulator, VoteAccumulator
+from atlasStatistics import AtlasStatistics
+from atlasFormats import AtlasWriter
+from catalog import DatasetCatalog
+from transformCache import TransformCache
+from profiling import profiler
 
 
 class Atlas:
     util = Utils()
 
 
-    def __init__(self, fixedImagePath,  movingImagePaths, paramterFolder):
+    def __init__(self, fixedImagePath,  movingImagePaths, paramterFolder, maskFolder=None, margin=8, atlasFormat="float32", topK=2, catalog=None,
+                 numberOfLabels=3):
         self.fixedImagePath = fixedImagePath
         self.movingImagePaths = movingImagePaths
+        self.catalog = DatasetCatalog() if catalog is None else catalog # labels and transforms by subject id
         self.labelPathsToPropagate = self.getAllRelativeLabelPaths()
         self.paramterFolder = paramterFolder
-        self.numberOfLabels = 3
+        self.numberOfLabels = numberOfLabels # labels 1..numberOfLabels get an atlas channel, larger ones count as background
+        self.labelAccumulationType = np.uint16 # integer vote counts
+        self.intensityAccumulationType = np.float64
+        self.maskFolder = maskFolder # brain masks (or label maps) for registration and the accumulation region
+        self.margin = margin # voxels kept around the fixed brain mask
+        self.region = None
+        self.volumeShape = None
+        self.atlasFormat = atlasFormat # float32, uint8, uint16 or sparse
+        self.topK = topK # labels kept per voxel in the sparse format
 
     ######################################################
     ### Registration #####################################
     ######################################################     
 
-    def registerAllImages(self):
-        # registers all moving images
-        for movingImagePath in movingImagePaths:
-            reg = Registration(self.paramterFolder)
-            reg.register(self.fixedImagePath, movingImagePath)
-
-            del reg
-            gc.collect()
+    def registerAllImages(self, numberOfWorkers=None, threadsPerWorker=None, maxRetries=1, cacheFolder=None, staged=False):
+        # registers all moving images in a process pool (one elastix run per worker). With a cacheFolder,
+        # registrations of unchanged images and parameter files are taken from the TransformCache,
+        # staged additionally reuses the cached rigid/affine stages when only a later stage changed
+        scheduler = RegistrationScheduler(self.paramterFolder, numberOfWorkers, threadsPerWorker, maxRetries, cacheFolder=cacheFolder, staged=staged,
+                                          maskFolder=self.maskFolder)
+        scheduler.run(self.fixedImagePath, self.movingImagePaths)
+        return scheduler.failed
 
 
     ######################################################
     ### Label Propagation ################################
     ######################################################
 
-    def propagate(self):
-        # propagates the labels (only of the moving images)
+    def propagate(self, singlePass=True, perLabelImages=False):
+        # propagates the labels (only of the moving images). By default one integer label map is stored per subject,
+        # perLabelImages stores a binary float image per label instead (the former layout)
+        self.catalog.refresh() # picks up the transforms of the registration
         for labelPath in self.labelPathsToPropagate:
-            matrixPaths = self.matchLabelPathToMatrixPaths(labelPath)
-            transformParameterObject = self.util.loadTransformParameterObject(matrixPaths)
-            labelImage = self.util.loadImageFrom(labelPath)
+            subject = os.path.basename(labelPath).split("_")[0]
+            with profiler.stage("read label", subject):
+                matrixPaths = self.matchLabelPathToMatrixPaths(labelPath)
+                transformParameterObject = self.util.loadTransformParameterObject(matrixPaths)
+                labelImage = self.util.loadImageFrom(labelPath)
+            with profiler.stage("propagate labels", subject):
+                if not perLabelImages:
+                    propagatedLabelMap = self.propagateLabelMap(labelImage, transformParameterObject)
+                    self.storePropagatedLabelMap(labelPath, self.labelArrayFrom(propagatedLabelMap), propagatedLabelMap)
+                    continue
+                for label, propagatedImage in self.propagateLabels(labelImage, transformParameterObject, singlePass):
+                    self.storePropagatedLabel(labelPath, label, propagatedImage)
+
+    def storePropagatedLabelMap(self, labelPath, labelArray, referenceImage):
+        # stores a propagated label map as propagated_labels/<id>.nii.gz, uint8 if all labels fit
+        subject = os.path.basename(labelPath).split("_")[0]
+        dtype = np.uint8 if labelArray.max(initial=0) <= np.iinfo(np.uint8).max else np.uint16
+        labelMapImage = itk.GetImageFromArray(labelArray.astype(dtype))
+        labelMapImage.CopyInformation(referenceImage)
+        storeFolder = "propagated_labels"
+        self.util.ensureFolderExists(storeFolder)
+        with profiler.stage("write nifti", subject):
+            itk.imwrite(labelMapImage, os.path.join(storeFolder, subject + ".nii.gz"))
+
+    @staticmethod
+    def storePropagatedLabel(labelPath, label, propagatedImage):
+        # stores a propagated binary label image
+        fileName = os.path.basename(labelPath)
+        fileNumber = fileName.split(".")[0]
+        storeName = fileNumber + f"_label_{label}.nii.gz"
+        storeFolder = f"propagated_images/label_{label}"
+        Atlas.util.ensureFolderExists(storeFolder)
+        imagePath = os.path.join(storeFolder, storeName)
+        with profiler.stage("write nifti", fileNumber.split("_")[0]):
+            itk.imwrite(propagatedImage,imagePath)
+
+    def propagateLabels(self, labelImage, transformParameterObject, singlePass=True):
+        # yields (label, propagated binary image). singlePass transforms the whole label map with one transformix call
+        if not singlePass:
             for label in range(1, self.numberOfLabels + 1):
                 image = self.extractLabel(labelImage, label)
-                propagatedImage = self.applyTransform(image, transformParameterObject)
+                yield label, self.applyTransform(image, transformParameterObject)
+            return
 
-                fileName = os.path.basename(labelPath)
-                fileNumber = fileName.split(".")[0]
-                storeName = fileNumber + f"_label_{label}.nii.gz"
-                storeFolder = f"propagated_images/label_{label}"
-                self.util.ensureFolderExists(storeFolder)
-                imagePath = os.path.join(storeFolder, storeName)
-                itk.imwrite(propagatedImage,imagePath)
+        propagatedLabelMap = self.propagateLabelMap(labelImage, transformParameterObject)
+        labelArray = self.labelArrayFrom(propagatedLabelMap)
+        for label in range(1, self.numberOfLabels + 1):
+            image = itk.GetImageFromArray((labelArray == label).astype(np.float32))
+            image.CopyInformation(propagatedLabelMap) # copy metadata
+            yield label, image
 
+    def propagateLabelMap(self, labelImage, transformParameterObject):
+        # transforms the full label map at once. Nearest neighbour resampling picks a single
+        # source voxel, so splitting the result equals thresholding each label before the transform
+        self.util.setNearestNeighbourInterpolation(transformParameterObject)
+        return self.applyTransform(labelImage, transformParameterObject)
+
+    @staticmethod
+    def labelArrayFrom(labelMapImage):
+        # converts a (float) label map image to an integer array
+        return np.rint(itk.GetArrayViewFromImage(labelMapImage)).astype(np.uint16)
 
     def applyTransform(self, movingImage, transformParameterObject):
         # applies the transformation to the moving image
-        resultImage = itk.transformix_filter(
-            movingImage,
-            transform_parameter_object=transformParameterObject
-        )
+        with profiler.stage("transformix"):
+            resultImage = itk.transformix_filter(
+                movingImage,
+                transform_parameter_object=transformParameterObject
+            )
         return resultImage
             
      
     def matchLabelPathToMatrixPaths(self, labelPath):
         # matches the labelpath to the matrixpath (the path of the transformation files)
-        matrixPaths = []
-        matrixFolder = "transformationMatrices"
-        fileName = os.path.basename(labelPath)
-        fileNumber = fileName.split("_")[0]
-
-        for filePath in os.listdir(matrixFolder):
-            if fileNumber in filePath:
-                finalPath = os.path.join(matrixFolder, filePath)
-                matrixPaths.append(finalPath)
-        sortedMatrixPaths= sorted(matrixPaths, key=self.util.getRegistrationSortKey)
-
-        return sortedMatrixPaths
+        return self.catalog.transformPaths(self.util.subjectId(labelPath))
         
     @staticmethod
     def extractLabel(inputImage, label):
@@ -100,14 +153,15 @@ class Atlas:
 
     def getAllRelativeLabelPaths(self):
         # returns all relative label paths of the moving images
-        labelFolder = "training-set/training-labels"
         AllFileNumbers = self.getAllFileNumbers(self.movingImagePaths)
-        labelPathsToPropagate = []
-        for fileNumber in AllFileNumbers:
-            labelName = fileNumber + "_3C.nii.gz"
-            labelPath = os.path.join(labelFolder, labelName)
-            labelPathsToPropagate.append(labelPath)
-        return labelPathsToPropagate
+        return [self.labelPathFor(fileNumber) for fileNumber in AllFileNumbers]
+
+    def labelPathFor(self, fileNumber):
+        # the label map of a subject, <id>_3C.nii.gz unless the catalog knows another one
+        labelPath = self.catalog.path("label", self.util.subjectId(fileNumber))
+        if labelPath is None:
+            labelPath = os.path.join("training-set/training-labels", fileNumber + "_3C.nii.gz")
+        return labelPath
 
     @staticmethod
     def getAllFileNumbers(relativePaths):
@@ -124,51 +178,84 @@ class Atlas:
     ### Building The Probabalistic Atlas #################
     ######################################################
 
-    def buildAtlas(self):
-        # builds the atlas and saves it as a nii.gz
+    def buildAtlas(self, perLabelImages=False):
+        # builds the atlas and saves it as a nii.gz. Votes are counted from the propagated label maps in one pass per
+        # subject, perLabelImages reads the binary images of the former layout instead
+        if not perLabelImages:
+            with profiler.stage("build atlas"):
+                votes = self.countVotes(self.util.getAllFiles("propagated_labels"))
+                atlases = [self.uncrop(votes.probability(label))[..., np.newaxis] for label in range(1, self.numberOfLabels + 1)]
+            with profiler.stage("store atlas"):
+                self.storeAtlas(atlases)
+            return
+
         atlases = []
         for label in range(1, self.numberOfLabels + 1):
-            labelFolder = f"propagated_images/label_{label}"
-            labelImagePaths = self.util.getAllFiles(labelFolder)
-            labelImages = self.loadAllImagesFromList(labelImagePaths)
-            atlas = self.probabilisticAtlas(labelImages)
-            atlas = atlas[..., np.newaxis] # new axis for storing
-            atlases.append(atlas)
-        self.storeAtlas(atlases)
-
-    def loadAllImagesFromList(self, pathList):
-        # loads all images from pathList
-        allImages = [] 
+            with profiler.stage("build atlas", label=label):
+                labelFolder = f"propagated_images/label_{label}"
+                labelImagePaths = self.util.getAllFiles(labelFolder)
+                labelImages = self.iterateImagesFromList(labelImagePaths)
+                atlas = self.probabilisticAtlas(labelImages, self.labelAccumulationType)
+                atlas = self.uncrop(atlas)[..., np.newaxis] # new axis for storing
+                atlases.append(atlas)
+        with profiler.stage("store atlas"):
+            self.storeAtlas(atlases)
+
+    def iterateImagesFromList(self, pathList):
+        # loads the images from pathList one at a time, cropped to the accumulation region
         for imagePath in pathList:
-            allImages.append(self.util.loadImageFrom(imagePath))
-        return allImages
+            yield self.crop(itk.GetArrayViewFromImage(self.util.loadImageFrom(imagePath)))
+
+    def accumulationRegion(self):
+        # bounding box of the fixed brain mask plus margin, the accumulators skip the background outside of it.
+        # Without a mask the whole volume is used
+        if self.region is None:
+            maskPath = self.util.findMaskPath(self.fixedImagePath, self.maskFolder)
+            if maskPath is None:
+                self.region = (slice(None),) * 3
+            else:
+                mask = itk.GetArrayViewFromImage(self.util.loadImageFrom(maskPath)) > 0
+                self.region = self.util.boundingBox(mask, self.margin)
+                self.volumeShape = mask.shape
+        return self.region
+
+    def crop(self, array):
+        return array[self.accumulationRegion()]
+
+    def uncrop(self, array):
+        # pads an accumulated array back to the full volume before it is written
+        if self.volumeShape is None:
+            return array
+        return self.util.uncrop(array, self.region, self.volumeShape)
+
+    def countVotes(self, labelMapPaths):
+        # label votes of all label maps, read in their integer type and cropped to the accumulation region
+        votes = VoteAccumulator(self.numberOfLabels, self.labelAccumulationType)
+        for labelMapPath in labelMapPaths:
+            votes.add(self.crop(self.util.readLabelMap(labelMapPath)))
+        return votes
 
     @staticmethod
-    def probabilisticAtlas(labelImages):
-        # calculates the probabilistic Atlas 
-        probabilisticAtlas = np.zeros(labelImages[0].shape)
-        maskClass = np.zeros(labelImages[0].shape)
+    def probabilisticAtlas(labelImages, accumulationType=np.float64):
+        # calculates the probabilistic Atlas, streaming over the registered masks
+        accumulator = RunningAccumulator(accumulationType)
         for registeredMask in labelImages:
-
-            maskClass += registeredMask
-
-        maskClass/=len(labelImages)
-
-        return maskClass
+            accumulator.add(registeredMask)
+        return accumulator.mean()
 
     def storeAtlas(self, atlases): 
-        # stores the atlas           
-        _, affine = self.readNiftiImage(self.fixedImagePath)
+        # stores the atlas in self.atlasFormat (see AtlasWriter), sparse atlases are folders
+        affine = self.util.readNiftiAffine(self.fixedImagePath)
         finalAtlas = np.concatenate(atlases, axis=-1)
         reorderedImage = np.transpose(finalAtlas, (2, 1, 0, 3))
-        newImage = nib.Nifti1Image(reorderedImage,affine)
-        newImage.to_filename('atlas.nii.gz')
+        atlasPath = 'atlas_sparse' if self.atlasFormat == "sparse" else 'atlas.nii.gz'
+        AtlasWriter(self.atlasFormat, self.topK).write(reorderedImage, affine, atlasPath)
 
     @staticmethod
     def readNiftiImage(filePath):
         # reads a nifti 
         if not os.path.exists(filePath):
-            raise FileNotFoundError(f"The file {imagePath} does not exist.")
+            raise FileNotFoundError(f"The file {filePath} does not exist.")
         try:
             niftiImage = nib.load(filePath)
             return niftiImage.get_fdata(), niftiImage.affine
@@ -179,57 +266,141 @@ class Atlas:
     ### Building The mean image ##########################
     ######################################################
 
-    def buildMeanImage(self):
-        # computes and stores the mean image
+    def buildMeanImage(self, storeVariance=False):
+        # computes and stores the mean image (and optionally the voxel-wise variance)
         self.propagateImages()
         propagatedImagePaths = self.util.getAllFiles("propagated_intesities")
 
-        fixedImage = self.util.loadImageFrom(self.fixedImagePath)
-        meanImage = itk.GetArrayFromImage(fixedImage)
+        with profiler.stage("build mean image"):
+            accumulator = RunningAccumulator(self.intensityAccumulationType, trackVariance=storeVariance)
+            for image in self.iterateImagesFromList([self.fixedImagePath] + propagatedImagePaths):
+                accumulator.add(image)
 
-        for imagePath in propagatedImagePaths:
-            image = self.util.loadImageFrom(imagePath)
-            meanImage += image
-        
-        meanImage /= len(propagatedImagePaths)
-        self.storeMeanImage(meanImage)
+        with profiler.stage("store mean image"):
+            self.storeMeanImage(self.uncrop(accumulator.mean()))
+            if storeVariance:
+                self.storeMeanImage(self.uncrop(accumulator.variance()), 'varianceImage.nii.gz')
 
 
     def propagateImages(self):
         # applies the calculated registrations to all moving images
-        for movingImagePath in movingImagePaths:
-            matrixPaths = self.matchImagePathToMatrixPaths(movingImagePath)
-            transformParameterObject = self.util.loadTransformParameterObject(matrixPaths)
-            movigImage = self.util.loadImageFrom(movingImagePath)
-            propagatedImage = self.applyTransform(movigImage, transformParameterObject)
-
-            storeName = os.path.basename(movingImagePath)
-            storeFolder = f"propagated_intesities/"
-            self.util.ensureFolderExists(storeFolder)
-            imagePath = os.path.join(storeFolder, storeName)
+        self.catalog.refresh()
+        for movingImagePath in self.movingImagePaths:
+            with profiler.stage("propagate image", os.path.basename(movingImagePath).split(".")[0]):
+                matrixPaths = self.matchImagePathToMatrixPaths(movingImagePath)
+                transformParameterObject = self.util.loadTransformParameterObject(matrixPaths)
+                movigImage = self.util.loadImageFrom(movingImagePath)
+                propagatedImage = self.applyTransform(movigImage, transformParameterObject)
+                self.storePropagatedImage(movingImagePath, propagatedImage)
+
+    @staticmethod
+    def storePropagatedImage(movingImagePath, propagatedImage):
+        # stores a propagated intensity image
+        storeName = os.path.basename(movingImagePath)
+        storeFolder = f"propagated_intesities/"
+        Atlas.util.ensureFolderExists(storeFolder)
+        imagePath = os.path.join(storeFolder, storeName)
+        with profiler.stage("write nifti", storeName.split(".")[0]):
             itk.imwrite(propagatedImage,imagePath)
 
     def matchImagePathToMatrixPaths(self, imagePath):
         # matches the image path to the matrix paths (the path of the transformation files)
-        matrixPaths = []
-        matrixFolder = "transformationMatrices"
-        fileName = os.path.basename(imagePath)
-        fileNumber = fileName.split(".")[0]
+        return self.catalog.transformPaths(self.util.subjectId(imagePath))
 
-        for filePath in os.listdir(matrixFolder):
-            if fileNumber in filePath:
-                finalPath = os.path.join(matrixFolder, filePath)
-                matrixPaths.append(finalPath)
-        sortedMatrixPaths= sorted(matrixPaths, key=self.util.getRegistrationSortKey)
-
-        return sortedMatrixPaths
-
-    def storeMeanImage(self, meanImage):
+    def storeMeanImage(self, meanImage, fileName='meanImage.nii.gz'):
         # stores the mean images as a nii.gz            
-        _, affine = self.readNiftiImage(self.fixedImagePath)
+        affine = self.util.readNiftiAffine(self.fixedImagePath)
         reorderedImage = np.transpose(meanImage, (2, 1, 0))
         newImage = nib.Nifti1Image(reorderedImage,affine)
-        newImage.to_filename('meanImage.nii.gz')
+        newImage.to_filename(fileName)
+
+    ######################################################
+    ### In-Memory Pipeline ###############################
+    ######################################################
+
+    def buildInMemory(self, numberOfWorkers=None, threadsPerWorker=None, maxRetries=1, checkpoint=False, cacheFolder=None):
+        # registers, propagates and accumulates without writing intermediate files.
+        # checkpoint=True additionally stores the transforms and propagated images of the staged pipeline
+        scheduler = RegistrationScheduler(self.paramterFolder, numberOfWorkers, threadsPerWorker, maxRetries, storeTransforms=checkpoint, cacheFolder=cacheFolder,
+                                          maskFolder=self.maskFolder)
+        transformMaps = scheduler.run(self.fixedImagePath, self.movingImagePaths)
+        labelPaths = dict(zip(self.movingImagePaths, self.labelPathsToPropagate))
+
+        intensityAccumulator = RunningAccumulator(self.intensityAccumulationType)
+        intensityAccumulator.add(self.crop(itk.GetArrayViewFromImage(self.util.loadImageFrom(self.fixedImagePath))))
+        votes = VoteAccumulator(self.numberOfLabels, self.labelAccumulationType)
+
+        for movingImagePath in self.movingImagePaths:
+            if movingImagePath not in transformMaps:
+                continue # registration failed
+            with profiler.stage("propagate subject", os.path.basename(movingImagePath).split(".")[0]):
+                self.accumulateSubject(movingImagePath, labelPaths[movingImagePath], transformMaps[movingImagePath],
+                                       votes, intensityAccumulator, checkpoint)
+
+        atlases = [self.uncrop(votes.probability(label))[..., np.newaxis] for label in range(1, self.numberOfLabels + 1)]
+        self.storeAtlas(atlases)
+        self.storeMeanImage(self.uncrop(intensityAccumulator.mean()))
+
+    def accumulateSubject(self, movingImagePath, labelPath, transformMaps, votes, intensityAccumulator, checkpoint):
+        # propagates the labels and the image of one subject and adds them to the accumulators
+        transformParameterObject = self.util.parameterObjectFromMaps(transformMaps)
+
+        labelImage = self.util.loadImageFrom(labelPath)
+        propagatedLabelMap = self.propagateLabelMap(labelImage, transformParameterObject)
+        labelArray = self.labelArrayFrom(propagatedLabelMap)
+        votes.add(self.crop(labelArray))
+        if checkpoint:
+            self.storePropagatedLabelMap(labelPath, labelArray, propagatedLabelMap)
+
+        movingImage = self.util.loadImageFrom(movingImagePath)
+        propagatedImage = self.applyTransform(movingImage, transformParameterObject)
+        intensityAccumulator.add(self.crop(itk.GetArrayViewFromImage(propagatedImage)))
+        if checkpoint:
+            self.storePropagatedImage(movingImagePath, propagatedImage)
+
+    ######################################################
+    ### Incremental Update ###############################
+    ######################################################
+
+    def updateAtlas(self, addedImagePaths=(), removedSubjectIds=(), statisticsFolder="atlasStatistics", numberOfThreads=None, cacheFolder=None):
+        # adds/removes subjects to/from the stored atlas statistics and regenerates atlas.nii.gz and meanImage.nii.gz.
+        # A new subject costs one registration, unchanged subjects (same content hash of image, label and mask) are skipped.
+        # Statistics that were built against another fixed image, fixed mask or other parameter files are refused
+        self.catalog.refresh() # picks up the labels of the added subjects
+        reg = Registration(self.paramterFolder, None if cacheFolder is None else TransformCache(cacheFolder))
+        fixedHash = self.util.hashFile(self.fixedImagePath)
+        fixedMaskPath = self.util.findMaskPath(self.fixedImagePath, self.maskFolder)
+        provenance = {"fixedImage": fixedHash,
+                      "fixedMask": None if fixedMaskPath is None else self.util.hashFile(fixedMaskPath),
+                      "parameters": {os.path.basename(path): self.util.hashFile(path) for path in reg.parameterPaths}}
+        statistics = AtlasStatistics.load(statisticsFolder, self.numberOfLabels, self.labelAccumulationType, provenance)
+        fixedId = self.getAllFileNumbers([self.fixedImagePath])[0]
+        if not statistics.hasSubject(fixedId, fixedHash):
+            fixedImage = self.util.loadImageFrom(self.fixedImagePath)
+            statistics.addSubject(fixedId, fixedHash, None, itk.GetArrayViewFromImage(fixedImage))
+
+        for subjectId in removedSubjectIds:
+            statistics.removeSubject(subjectId)
+
+        for movingImagePath in addedImagePaths:
+            subjectId = self.getAllFileNumbers([movingImagePath])[0]
+            labelPath = self.labelPathFor(subjectId)
+            movingMaskPath = self.util.findMaskPath(movingImagePath, self.maskFolder)
+            contentHash = self.util.hashFiles([path for path in (movingImagePath, labelPath, movingMaskPath) if path is not None])
+            if statistics.hasSubject(subjectId, contentHash):
+                continue
+            if statistics.hasSubject(subjectId):
+                statistics.removeSubject(subjectId) # the subject changed
+
+            transformParameterObject = reg.register(self.fixedImagePath, movingImagePath, numberOfThreads, fixedMaskPath=fixedMaskPath, movingMaskPath=movingMaskPath)
+            labelArray = self.labelArrayFrom(self.propagateLabelMap(self.util.loadImageFrom(labelPath), transformParameterObject))
+            propagatedImage = self.applyTransform(self.util.loadImageFrom(movingImagePath), transformParameterObject)
+            statistics.addSubject(subjectId, contentHash, labelArray, itk.GetArrayViewFromImage(propagatedImage))
+
+        statistics.save()
+        self.storeAtlas(statistics.atlas())
+        self.storeMeanImage(statistics.meanImage())
+        return statistics
 
 
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+import os
+import json
+import numpy as np
+import nibabel as nib
+
+
+class AtlasWriter:
+    # writes the probabilistic atlas (x, y, z, numberOfLabels) in one of several layouts:
+    #   float32        4D nifti, as before but in single precision
+    #   uint8, uint16  4D nifti with quantized probabilities and scl_slope = 1 / max, nibabel scales on reading
+    #   sparse         folder with the topK labels and probabilities of every voxel inside the atlas
+    #                  (header.json, indices.npy, labels.npy, probabilities.npy), read with memory maps
+    formats = ("float32", "uint8", "uint16", "sparse")
+
+    def __init__(self, atlasFormat="float32", topK=2):
+        if atlasFormat not in self.formats:
+            raise ValueError(f"Unknown atlas format {atlasFormat}, choose one of {self.formats}")
+        self.atlasFormat = atlasFormat
+        self.topK = topK
+
+    def write(self, probabilities, affine, path):
+        # probabilities in nifti (x, y, z, label) order. Returns the written path
+        if self.atlasFormat == "float32":
+            nib.Nifti1Image(probabilities.astype(np.float32), affine).to_filename(path)
+        elif self.atlasFormat == "sparse":
+            self.writeSparse(probabilities, affine, path)
+        else:
+            self.writeQuantized(probabilities, affine, path, np.dtype(self.atlasFormat))
+        return path
+
+    @staticmethod
+    def writeQuantized(probabilities, affine, path, dtype):
+        maxValue = np.iinfo(dtype).max
+        quantized = np.rint(np.clip(probabilities, 0, 1) * maxValue).astype(dtype)
+        image = nib.Nifti1Image(quantized, affine)
+        image.header.set_slope_inter(1 / maxValue, 0)
+        image.to_filename(path)
+
+    def writeSparse(self, probabilities, affine, folder):
+        # only voxels with a nonzero probability are stored, each with its topK labels (1-based, 0 = unused slot)
+        # sorted by probability. Probabilities are quantized to uint8
+        shape = probabilities.shape[:-1]
+        numberOfLabels = probabilities.shape[-1]
+        topK = min(self.topK, numberOfLabels)
+        flatProbabilities = probabilities.reshape(-1, numberOfLabels)
+        indexType = np.uint32 if flatProbabilities.shape[0] < 2**32 else np.uint64
+        indices = np.flatnonzero(flatProbabilities.max(axis=1) > 0).astype(indexType)
+
+        voxelProbabilities = flatProbabilities[indices]
+        order = np.argsort(-voxelProbabilities, axis=1, kind="stable")[:, :topK]
+        topProbabilities = np.take_along_axis(voxelProbabilities, order, axis=1)
+        labelType = np.uint8 if numberOfLabels < 2**8 else np.uint16
+        labels = np.where(topProbabilities > 0, order + 1, 0).astype(labelType)
+
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, "indices.npy"), indices)
+        np.save(os.path.join(folder, "labels.npy"), labels)
+        np.save(os.path.join(folder, "probabilities.npy"), np.rint(np.clip(topProbabilities, 0, 1) * 255).astype(np.uint8))
+        header = {"format": "sparse", "shape": list(shape), "numberOfLabels": numberOfLabels, "topK": topK,
+                  "scale": 1 / 255, "affine": np.asarray(affine).tolist()}
+        with open(os.path.join(folder, "header.json"), "w") as file:
+            json.dump(header, file)
+
+
+class AtlasReader:
+    # reads single labels or regions of an atlas written by AtlasWriter (or any 4D nifti atlas) without decoding
+    # the whole volume. Regions are tuples of slices in nifti (x, y, z) order, labels count from 1.
+    # Uncompressed .nii files are memory mapped, so only the requested part is read from disk
+
+    def __init__(self, atlasPath):
+        self.atlasPath = atlasPath
+        self.sparse = os.path.isdir(atlasPath)
+        if self.sparse:
+            with open(os.path.join(atlasPath, "header.json")) as file:
+                self.header = json.load(file)
+            self.shape = tuple(self.header["shape"])
+            self.numberOfLabels = self.header["numberOfLabels"]
+            self.affine = np.array(self.header["affine"])
+            self.indices = np.load(os.path.join(atlasPath, "indices.npy"), mmap_mode="r")
+            self.labels = np.load(os.path.join(atlasPath, "labels.npy"), mmap_mode="r")
+            self.quantized = np.load(os.path.join(atlasPath, "probabilities.npy"), mmap_mode="r")
+        else:
+            self.image = nib.load(atlasPath)
+            self.shape = self.image.shape[:3]
+            self.numberOfLabels = self.image.shape[3]
+            self.affine = self.image.affine
+
+    def probability(self, label, region=None):
+        # probability map of one label (x, y, z) as float32
+        return self.probabilities(region, labels=[label])[..., 0]
+
+    def probabilities(self, region=None, labels=None):
+        # probabilities of the given labels (default: all) in the region (default: whole volume) as (x, y, z, label)
+        region = self.normalizeRegion(region)
+        labels = list(range(1, self.numberOfLabels + 1)) if labels is None else list(labels)
+        if not self.sparse:
+            channels = [label - 1 for label in labels]
+            if channels == list(range(channels[0], channels[-1] + 1)): # contiguous, a single proxy read
+                return np.asarray(self.image.dataobj[region + (slice(channels[0], channels[-1] + 1),)], dtype=np.float32)
+            return np.stack([np.asarray(self.image.dataobj[region + (channel,)], dtype=np.float32) for channel in channels], axis=-1)
+
+        regionShape = tuple(part.stop - part.start for part in region)
+        result = np.zeros(regionShape + (len(labels),), dtype=np.float32)
+        selected = self.voxelsInRegion(region)
+        coordinates = np.unravel_index(np.asarray(self.indices[selected], dtype=np.int64), self.shape)
+        localCoordinates = tuple(coordinate - part.start for coordinate, part in zip(coordinates, region))
+        voxelLabels = np.asarray(self.labels[selected])
+        voxelProbabilities = np.asarray(self.quantized[selected], dtype=np.float32) * self.header["scale"]
+        for position, label in enumerate(labels):
+            voxel, rank = np.nonzero(voxelLabels == label)
+            result[tuple(coordinate[voxel] for coordinate in localCoordinates) + (position,)] = voxelProbabilities[voxel, rank]
+        return result
+
+    def normalizeRegion(self, region):
+        # full slices with explicit bounds, only unit steps are supported
+        region = (slice(None),) * 3 if region is None else tuple(region)
+        bounds = []
+        for part, size in zip(region, self.shape):
+            start, stop, step = part.indices(size)
+            if step != 1:
+                raise ValueError("Atlas regions must have unit steps")
+            bounds.append(slice(start, max(stop, start)))
+        return tuple(bounds)
+
+    def voxelsInRegion(self, region):
+        # positions in the sparse arrays of the stored voxels inside region. Every (x, y) row of the region is a
+        # contiguous range of flat indices, found with two binary searches
+        xs, ys = np.meshgrid(np.arange(region[0].start, region[0].stop), np.arange(region[1].start, region[1].stop), indexing="ij")
+        rowStarts = (xs.ravel().astype(np.int64) * self.shape[1] + ys.ravel()) * self.shape[2] + region[2].start
+        first = np.searchsorted(self.indices, rowStarts)
+        last = np.searchsorted(self.indices, rowStarts + (region[2].stop - region[2].start))
+        lengths = last - first
+        return np.arange(lengths.sum()) + np.repeat(first - np.cumsum(lengths) + lengths, lengths)
@@ -0,0 +1,132 @@
+import os
+import json
+import numpy as np
+
+from utils import Utils
+from accumulator import RunningAccumulator
+
+
+class AtlasStatistics:
+    # persistent sufficient statistics of an atlas: per-label vote counts, intensity sum and sum of squares
+    # and the contributing subjects (subjectId -> content hash). Each subject's propagated label map and
+    # intensities are kept next to the statistics, so a subject can be subtracted again later.
+    # The provenance (hashes of the fixed image and the parameter files) is stored with them, statistics of a
+    # different space or registration setup are refused on load.
+    util = Utils()
+
+    def __init__(self, folder, numberOfLabels, labelAccumulationType=np.uint16):
+        self.folder = folder
+        self.numberOfLabels = numberOfLabels
+        self.subjects = {}
+        self.provenance = None
+        self.labelAccumulators = [RunningAccumulator(labelAccumulationType) for _ in range(numberOfLabels)]
+        self.intensityAccumulator = RunningAccumulator(np.float64, trackVariance=True)
+
+    ######################################################
+    ### Updating #########################################
+    ######################################################
+
+    def hasSubject(self, subjectId, contentHash=None):
+        # True if the subject is part of the statistics (and unchanged, if a hash is given)
+        if subjectId not in self.subjects:
+            return False
+        return contentHash is None or self.subjects[subjectId] == contentHash
+
+    def addSubject(self, subjectId, contentHash, labelArray, intensityArray):
+        # adds the propagated label map (None for the fixed image) and intensities of one subject
+        if subjectId in self.subjects:
+            raise ValueError(f"Subject {subjectId} is already part of the atlas")
+        self.updateAccumulators(labelArray, intensityArray, sign=1)
+
+        contribution = {"intensities": np.asarray(intensityArray, dtype=np.float32)}
+        if labelArray is not None:
+            contribution["labels"] = labelArray
+        self.util.ensureFolderExists(self.subjectFolder())
+        np.savez(self.contributionPath(subjectId), **contribution)
+        self.subjects[subjectId] = contentHash
+
+    def removeSubject(self, subjectId):
+        # subtracts the stored contribution of a subject
+        if subjectId not in self.subjects:
+            raise ValueError(f"Subject {subjectId} is not part of the atlas")
+        contributionPath = self.contributionPath(subjectId)
+        with np.load(contributionPath) as contribution:
+            labelArray = contribution["labels"] if "labels" in contribution.files else None
+            self.updateAccumulators(labelArray, contribution["intensities"], sign=-1)
+        os.remove(contributionPath)
+        del self.subjects[subjectId]
+
+    def updateAccumulators(self, labelArray, intensityArray, sign):
+        update = "add" if sign > 0 else "subtract"
+        if labelArray is not None:
+            for label in range(1, self.numberOfLabels + 1):
+                getattr(self.labelAccumulators[label - 1], update)(labelArray == label)
+        getattr(self.intensityAccumulator, update)(intensityArray)
+
+    ######################################################
+    ### Outputs ##########################################
+    ######################################################
+
+    def atlas(self):
+        # list of the per-label probability maps, each with a new axis for storing
+        return [accumulator.mean()[..., np.newaxis] for accumulator in self.labelAccumulators]
+
+    def meanImage(self):
+        return self.intensityAccumulator.mean()
+
+    def varianceImage(self):
+        return self.intensityAccumulator.variance()
+
+    ######################################################
+    ### Persistence ######################################
+    ######################################################
+
+    def subjectFolder(self):
+        return os.path.join(self.folder, "subjects")
+
+    def contributionPath(self, subjectId):
+        return os.path.join(self.subjectFolder(), f"{subjectId}.npz")
+
+    def save(self):
+        # stores the statistics uncompressed, they are rewritten on every update
+        self.util.ensureFolderExists(self.folder)
+        arrays = {"intensitySum": self.intensityAccumulator.sum,
+                  "intensitySumOfSquares": self.intensityAccumulator.sumOfSquares}
+        for label, accumulator in enumerate(self.labelAccumulators, start=1):
+            arrays[f"votes_{label}"] = accumulator.sum
+        arrays = {name: array for name, array in arrays.items() if array is not None}
+        np.savez(os.path.join(self.folder, "statistics.npz"), **arrays)
+
+        header = {"provenance": self.provenance,
+                  "subjects": self.subjects,
+                  "intensityCount": self.intensityAccumulator.count,
+                  "labelCounts": [accumulator.count for accumulator in self.labelAccumulators]}
+        with open(os.path.join(self.folder, "statistics.json"), "w") as file:
+            json.dump(header, file, indent=2)
+
+    @classmethod
+    def load(cls, folder, numberOfLabels, labelAccumulationType=np.uint16, provenance=None):
+        # loads the statistics from folder, an empty object is returned if nothing was stored yet. With a provenance
+        # the stored statistics must have been built from the same fixed image, fixed mask and parameter files
+        statistics = cls(folder, numberOfLabels, labelAccumulationType)
+        statistics.provenance = provenance
+        headerPath = os.path.join(folder, "statistics.json")
+        if not os.path.exists(headerPath):
+            return statistics
+
+        with open(headerPath) as file:
+            header = json.load(file)
+        if provenance is not None and header.get("provenance") != provenance:
+            raise ValueError(f"The statistics in {folder} were built with a different fixed image, fixed mask or different parameter files, "
+                             "remove the folder to rebuild the atlas")
+        statistics.subjects = header["subjects"]
+        with np.load(os.path.join(folder, "statistics.npz")) as arrays:
+            if "intensitySum" in arrays.files:
+                statistics.intensityAccumulator.sum = arrays["intensitySum"]
+                statistics.intensityAccumulator.sumOfSquares = arrays["intensitySumOfSquares"]
+                statistics.intensityAccumulator.count = header["intensityCount"]
+            for label, accumulator in enumerate(statistics.labelAccumulators, start=1):
+                if f"votes_{label}" in arrays.files:
+                    accumulator.sum = arrays[f"votes_{label}"].astype(labelAccumulationType)
+                    accumulator.count = header["labelCounts"][label - 1]
+        return statistics
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import numpy as np
+
+from profiling import profiler
+from phantoms import PhantomGenerator
+# itk and the pipeline modules are imported by the stages that use them, so phantoms can be generated without elastix
+
+
+class Benchmark:
+    # times the pipeline stages on synthetic phantoms (see PhantomGenerator) and stores one json result per commit
+    # and configuration in resultFolder. Everything runs in workFolder, which gets the same layout as the real
+    # training set (training-set/training-images, training-labels), so the stages use the unchanged code paths
+    stages = ("registration", "propagation", "atlas", "mean image", "similarity", "similarity fast", "tissue histograms")
+
+    def __init__(self, workFolder="benchmarkData", resultFolder="benchmarks", size=128, numberOfSubjects=4, seed=0,
+                 parameterFolder=None, numberOfWorkers=None):
+        self.workFolder = os.path.abspath(workFolder)
+        self.resultFolder = os.path.abspath(resultFolder)
+        self.size = size
+        self.numberOfSubjects = numberOfSubjects
+        self.seed = seed
+        self.parameterFolder = None if parameterFolder is None else os.path.abspath(parameterFolder)
+        self.numberOfWorkers = numberOfWorkers
+        self.accuracy = None # Dice of the propagated labels, filled by the propagation stage
+        self.failedRegistrations = []
+
+    def run(self, stages=None):
+        # generates the phantoms (if needed), runs the stages in pipeline order and returns the path of the result
+        unknown = set(stages or ()) - set(self.stages)
+        if unknown:
+            raise ValueError(f"Unknown stages {sorted(unknown)}, choose from {self.stages}")
+        stages = self.stages if stages is None else [stage for stage in self.stages if stage in stages]
+        currentFolder = os.getcwd()
+        profiler.enable()
+        os.makedirs(self.workFolder, exist_ok=True)
+        os.chdir(self.workFolder) # the pipeline uses paths relative to the working directory
+        try:
+            with profiler.stage("benchmark generate phantoms", size=self.size, subjects=self.numberOfSubjects):
+                self.generatePhantoms()
+            if self.parameterFolder is None:
+                self.parameterFolder = self.writeDefaultParameters("parameters")
+            for stage in stages:
+                with profiler.stage(f"benchmark {stage}", size=self.size, subjects=self.numberOfSubjects):
+                    getattr(self, "run" + stage.title().replace(" ", ""))()
+        finally:
+            os.chdir(currentFolder)
+        return self.storeResult(stages)
+
+    def generatePhantoms(self):
+        # phantoms are only generated once per size, subject count and seed
+        markerPath = os.path.join("training-set", "phantoms.json")
+        configuration = {"size": self.size, "subjects": self.numberOfSubjects, "seed": self.seed}
+        if os.path.exists(markerPath):
+            with open(markerPath) as file:
+                if json.load(file) == configuration:
+                    return
+        PhantomGenerator(self.size, self.seed).generate(".", self.numberOfSubjects)
+        with open(markerPath, "w") as file:
+            json.dump(configuration, file)
+
+    @staticmethod
+    def writeDefaultParameters(parameterFolder):
+        # elastix default rigid, affine and bspline maps, so the benchmark does not need Par0038
+        import itk # itk-elastix
+        os.makedirs(parameterFolder, exist_ok=True)
+        parameterObject = itk.ParameterObject.New()
+        for registrationType in ("rigid", "affine", "bspline"):
+            parameterMap = parameterObject.GetDefaultParameterMap(registrationType)
+            parameterObject.WriteParameterFile(parameterMap, os.path.join(parameterFolder, f"{registrationType}.txt"))
+        return os.path.abspath(parameterFolder)
+
+    ######################################################
+    ### Stages ###########################################
+    ######################################################
+
+    def atlas(self):
+        from utils import Utils
+        from atlas import Atlas
+        imagePaths = Utils.getAllFiles("training-set/training-images")
+        fixedImagePath, movingImagePaths = Utils().splitFixedFromMoving(imagePaths, "1000")
+        return Atlas(fixedImagePath, movingImagePaths, self.parameterFolder)
+
+    def runRegistration(self):
+        # starts from no transforms, so a failed registration cannot leave an earlier run's transform behind
+        for folder in ("transformationMatrices", "propagated_labels"):
+            shutil.rmtree(folder, ignore_errors=True)
+        self.failedRegistrations = sorted(self.atlas().registerAllImages(self.numberOfWorkers))
+
+    def runPropagation(self):
+        self.atlas().propagate()
+        self.accuracy = self.propagationAccuracy()
+
+    def propagationAccuracy(self, fixedId="1000"):
+        # Dice per label of every propagated label map against the ground truth. All phantoms are the template warped
+        # by a known deformation and the fixed subject is the undeformed template, so a perfect registration
+        # maps every subject's labels exactly onto the fixed labels
+        import nibabel as nib
+        truth = np.asanyarray(nib.load(os.path.join("training-set", "training-labels", f"{fixedId}_3C.nii.gz")).dataobj)
+        labels = [int(label) for label in np.unique(truth) if label > 0]
+        subjects = {}
+        for fileName in sorted(os.listdir("propagated_labels")):
+            propagated = np.rint(np.asanyarray(nib.load(os.path.join("propagated_labels", fileName)).dataobj))
+            subjects[fileName.split(".")[0]] = {str(label): self.dice(propagated == label, truth == label) for label in labels}
+        meanDice = {str(label): float(np.mean([dice[str(label)] for dice in subjects.values()])) for label in labels} if subjects else {}
+        return {"meanDice": meanDice, "subjects": subjects}
+
+    @staticmethod
+    def dice(a, b):
+        total = np.count_nonzero(a) + np.count_nonzero(b)
+        return 2 * np.count_nonzero(a & b) / total if total else 1.0
+
+    def runAtlas(self):
+        self.atlas().buildAtlas()
+
+    def runMeanImage(self):
+        self.atlas().buildMeanImage()
+
+    def runSimilarity(self):
+        from Similarity import SimilarityAtlas
+        SimilarityAtlas().run(numberOfWorkers=self.numberOfWorkers)
+
+    def runSimilarityFast(self):
+        from Similarity import SimilarityAtlas
+        SimilarityAtlas().runFast()
+
+    def runTissueHistograms(self):
+        from tissueModels import TissueModels
+        tissueModels = TissueModels("training-set/training-images/", "training-set/training-labels/", self.numberOfWorkers)
+        tissueModels.computeDistribution(tissueModels.computeIntensityHistograms(), normalize=True)
+
+    ######################################################
+    ### Results ##########################################
+    ######################################################
+
+    def storeResult(self, stages):
+        # <resultFolder>/<commit>-<size>x<subjects>.json with the machine, the configuration and the stage timings
+        commit = self.currentCommit()
+        result = {
+            "commit": commit,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "configuration": {"size": self.size, "subjects": self.numberOfSubjects, "seed": self.seed,
+                              "workers": self.numberOfWorkers, "stages": list(stages)},
+            "machine": {"platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__,
+                        "cpus": os.cpu_count()},
+            "accuracy": self.accuracy,
+            "failedRegistrations": self.failedRegistrations,
+            "summary": profiler.summary(),
+            "records": profiler.records,
+        }
+        os.makedirs(self.resultFolder, exist_ok=True)
+        resultPath = os.path.join(self.resultFolder, f"{commit}-{self.size}x{self.numberOfSubjects}.json")
+        with open(resultPath, "w") as file:
+            json.dump(result, file, indent=2)
+        return resultPath
+
+    @staticmethod
+    def currentCommit():
+        # short hash of HEAD, marked dirty with uncommitted changes
+        sourceFolder = os.path.dirname(os.path.abspath(__file__))
+        try:
+            commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=sourceFolder, capture_output=True, text=True, check=True).stdout.strip()
+            dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=sourceFolder, capture_output=True, text=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return "unknown"
+        return commit + "-dirty" if dirty else commit
+
+    @staticmethod
+    def compare(baselinePath, resultPath):
+        # wall time per benchmark stage of two results and the speedup of the second, then the mean Dice per label
+        with open(baselinePath) as file:
+            baselineResult = json.load(file)
+        with open(resultPath) as file:
+            resultResult = json.load(file)
+        baseline, result = baselineResult["summary"], resultResult["summary"]
+        rows = []
+        for stage, total in result.items():
+            if stage.startswith("benchmark ") and stage in baseline:
+                rows.append((stage[len("benchmark "):], baseline[stage]["wallTime"], total["wallTime"],
+                             baseline[stage]["wallTime"] / max(total["wallTime"], 1e-9)))
+        for stage, before, after, speedup in rows:
+            print(f"{stage:<20} {before:>10.2f}s {after:>10.2f}s {speedup:>7.2f}x")
+        baselineDice = (baselineResult.get("accuracy") or {}).get("meanDice", {})
+        resultDice = (resultResult.get("accuracy") or {}).get("meanDice", {})
+        for label in sorted(set(baselineDice) & set(resultDice)):
+            print(f"{'dice label ' + label:<20} {baselineDice[label]:>11.4f} {resultDice[label]:>11.4f} {resultDice[label] - baselineDice[label]:>+8.4f}")
+        return rows
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    print(Benchmark(size=size).run())
@@ -0,0 +1,80 @@
+import os
+import sqlite3
+
+from utils import Utils
+
+
+class DatasetCatalog:
+    # sqlite index of the dataset: every file of the catalogued folders with its kind (image, label, transform, ...)
+    # and its exact subject id, so lookups are indexed queries instead of directory scans with substring matches.
+    # refresh() only rescans folders whose modification time changed (files were added, removed or renamed).
+    # databasePath ":memory:" keeps the index for the lifetime of the object only
+    util = Utils()
+    defaultFolders = {
+        "image": "training-set/training-images",
+        "label": "training-set/training-labels",
+        "transform": "transformationMatrices",
+        "propagated label": "propagated_labels",
+        "propagated image": "propagated_intesities",
+    }
+
+    def __init__(self, databasePath=":memory:", folders=None):
+        self.folders = dict(self.defaultFolders if folders is None else folders)
+        self.connection = sqlite3.connect(databasePath)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, kind TEXT, subject TEXT, name TEXT, size INTEGER, mtime INTEGER);
+            CREATE INDEX IF NOT EXISTS subjectIndex ON files (kind, subject);
+            CREATE TABLE IF NOT EXISTS folders (kind TEXT PRIMARY KEY, path TEXT, mtime INTEGER);
+        """)
+        self.refresh()
+
+    def refresh(self):
+        # brings the index up to date. Returns the number of folders that were rescanned
+        rescanned = 0
+        with self.connection:
+            for kind, folder in self.folders.items():
+                if folder is None:
+                    continue
+                mtime = os.stat(folder).st_mtime_ns if os.path.isdir(folder) else None
+                row = self.connection.execute("SELECT path, mtime FROM folders WHERE kind = ?", (kind,)).fetchone()
+                if row == (folder, mtime):
+                    continue
+                self.scanFolder(kind, folder)
+                self.connection.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)", (kind, folder, mtime))
+                rescanned += 1
+        return rescanned
+
+    def scanFolder(self, kind, folder):
+        # replaces the entries of one kind with the current content of its folder
+        rows = []
+        if os.path.isdir(folder):
+            for entry in os.scandir(folder):
+                if entry.is_file():
+                    stat = entry.stat()
+                    rows.append((os.path.join(folder, entry.name), kind, self.util.subjectId(entry.name), entry.name, stat.st_size, stat.st_mtime_ns))
+        self.connection.execute("DELETE FROM files WHERE kind = ?", (kind,))
+        self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    ######################################################
+    ### Lookup ###########################################
+    ######################################################
+
+    def paths(self, kind, subject):
+        # all files of a kind that belong to the subject, sorted by name
+        rows = self.connection.execute("SELECT path FROM files WHERE kind = ? AND subject = ? ORDER BY name", (kind, subject))
+        return [path for path, in rows]
+
+    def path(self, kind, subject):
+        # the first file of a kind that belongs to the subject, None if there is none
+        paths = self.paths(kind, subject)
+        return paths[0] if paths else None
+
+    def transformPaths(self, subject):
+        # the stored transforms of a subject in the order they are applied (rigid -> affine -> bspline)
+        return sorted(self.paths("transform", subject), key=self.util.getRegistrationSortKey)
+
+    def subjects(self, kind):
+        return [subject for subject, in self.connection.execute("SELECT DISTINCT subject FROM files WHERE kind = ? ORDER BY subject", (kind,))]
+
+    def close(self):
+        self.connection.close()
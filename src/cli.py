@@ -0,0 +1,289 @@
+import argparse
+
+from profiling import profiler
+
+# Only argparse and the (stdlib only) profiler are imported here. Each command imports its modules when it runs,
+# so commands that do not need itk, matplotlib or pandas start without loading them.
+
+
+######################################################
+### Atlas Commands ###################################
+######################################################
+
+def makeAtlas(args):
+    from utils import Utils
+    from atlas import Atlas
+    from catalog import DatasetCatalog
+    imagePaths = Utils.getAllFiles(args.images)
+    fixedImagePath, movingImagePaths = Utils().splitFixedFromMoving(imagePaths, args.fixed)
+    catalog = DatasetCatalog(args.catalog)
+    return Atlas(fixedImagePath, movingImagePaths, args.parameters, args.masks, args.margin, args.atlas_format, args.top_k, catalog, args.labels_count)
+
+
+def register(args):
+    makeAtlas(args).registerAllImages(args.workers, args.threads, args.retries, args.cache, args.staged)
+
+
+def propagate(args):
+    makeAtlas(args).propagate(perLabelImages=args.per_label_images)
+
+
+def buildAtlas(args):
+    makeAtlas(args).buildAtlas(args.per_label_images)
+
+
+def meanImage(args):
+    makeAtlas(args).buildMeanImage(storeVariance=args.variance)
+
+
+def build(args):
+    makeAtlas(args).buildInMemory(args.workers, args.threads, args.retries, args.checkpoint, args.cache)
+
+
+def template(args):
+    from utils import Utils
+    from template import TemplateBuilder
+    builder = TemplateBuilder(Utils.getAllFiles(args.images), args.parameters, args.output, args.iterations, args.tolerance, args.reuse_stages,
+                              args.workers, args.threads, args.retries, args.masks, args.time_limit and args.time_limit * 3600)
+    print(builder.build(args.reference))
+
+
+def fuse(args):
+    from labelFusion import LabelFusion
+    fusion = LabelFusion(args.method, args.labels_count, args.workers, args.block_voxels, args.store, args.patch_radius, args.power,
+                         args.iterations)
+    print(fusion.fuseToFile(args.labels, args.output, args.intensities or (), args.target))
+
+
+######################################################
+### Other Commands ###################################
+######################################################
+
+def tissueModels(args):
+    from tissueModels import TissueModels
+    TissueModels(args.images, args.labels, args.workers).execute(None if args.no_histograms else args.histograms)
+
+
+def qcReport(args):
+    from utils import Utils
+    from catalog import DatasetCatalog
+    from qcReport import QcReport
+    fixedImagePath, _ = Utils().splitFixedFromMoving(Utils.getAllFiles(args.images), args.fixed)
+    report = QcReport(args.output, args.dpi, args.workers, DatasetCatalog(args.catalog))
+    print(f"{len(report.run(fixedImagePath, args.histograms, args.atlas, args.mean_image, args.sections))} figures in {args.output}")
+
+
+def selectReference(args):
+    from utils import Utils
+    from Similarity import SimilarityAtlas
+    similarityAtlas = SimilarityAtlas(args.images, args.fixed)
+    if args.fast:
+        similarityAtlas.runFast(args.levels, args.top_k, args.metric)
+    else:
+        mask = None
+        if args.mask is not None:
+            import itk # itk-elastix
+            mask = itk.GetArrayViewFromImage(Utils.loadImageFrom(args.mask)) > 0 # brain of the fixed image
+        similarityAtlas.run(args.metric, args.downsample, mask, numberOfWorkers=args.workers)
+
+
+def segment(args):
+    from segmentation import AtlasSegmentation
+    segmentation = AtlasSegmentation(args.parameters, args.atlas, args.mean_image, args.tissue_model, args.em_iterations)
+    segmentation.segmentAll(args.scans, args.output, numberOfThreads=args.threads)
+
+
+def serve(args):
+    from service import SegmentationService
+    service = SegmentationService(args.parameters, args.atlas, args.mean_image, args.tissue_model,
+                                  args.workers, args.queue_size, args.threads, args.em_iterations)
+    service.serve(args.host, args.port)
+
+
+def benchmark(args):
+    from benchmark import Benchmark
+    if args.compare:
+        Benchmark.compare(*args.compare)
+        return
+    bench = Benchmark(args.work_folder, args.results, args.size, args.subjects, args.seed, args.parameters, args.workers)
+    print(bench.run(args.stages))
+
+
+######################################################
+### Argument Parsing #################################
+######################################################
+
+def addAtlasArguments(parser):
+    parser.add_argument("--images", default="training-set/training-images")
+    parser.add_argument("--fixed", default="1010", help="name of the fixed image")
+    parser.add_argument("--parameters", default="Par0038", help="folder with the elastix parameter files")
+    parser.add_argument("--masks", default=None, help="brain masks or label maps named after the images, e.g. training-set/training-labels")
+    parser.add_argument("--margin", type=int, default=8, help="voxels kept around the fixed brain mask when accumulating")
+    parser.add_argument("--atlas-format", choices=("float32", "uint8", "uint16", "sparse"), default="float32",
+                        help="quantized formats scale the probabilities, sparse stores the top-k labels per voxel in atlas_sparse/")
+    parser.add_argument("--top-k", type=int, default=2, help="labels per voxel in the sparse atlas")
+    parser.add_argument("--labels-count", type=int, default=3, help="highest label, e.g. 100+ for a parcellation, larger labels count as background")
+    parser.add_argument("--catalog", default=":memory:", help="sqlite file to keep the dataset index in between runs")
+
+
+def addPoolArguments(parser):
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--threads", type=int, default=None, help="elastix threads per worker")
+
+
+def addSegmentationArguments(parser):
+    parser.add_argument("--parameters", default="Par0038")
+    parser.add_argument("--atlas", default="atlas.nii.gz")
+    parser.add_argument("--mean-image", default="meanImage.nii.gz")
+    parser.add_argument("--tissue-model", default="TissueModel.csv", help="TissueModel.csv or the binary TissueModel.npz")
+    parser.add_argument("--em-iterations", type=int, default=0)
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(description="Probabilistic brain atlas and tissue models")
+    parser.add_argument("--volume-store", default=None, help="serve NIfTI reads from a memory mapped VolumeStore in this folder")
+    parser.add_argument("--profile", default=None, help="write a run report with time and memory per stage (.json or .csv)")
+    parser.add_argument("--call-profile", default=None, help="also write cProfile statistics to this file (needs --profile)")
+    parser.add_argument("--trace-memory", action="store_true", help="record peak python allocations per stage with tracemalloc")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("register", help="register all moving images to the fixed image")
+    addAtlasArguments(command)
+    addPoolArguments(command)
+    command.add_argument("--retries", type=int, default=1)
+    command.add_argument("--cache", default=None, help="TransformCache folder")
+    command.add_argument("--staged", action="store_true", help="one elastix call per stage, reusing cached stages")
+    command.set_defaults(function=register)
+
+    command = commands.add_parser("propagate", help="propagate the labels with the stored transforms")
+    addAtlasArguments(command)
+    command.add_argument("--per-label-images", action="store_true", help="store one binary float image per label (former layout)")
+    command.set_defaults(function=propagate)
+
+    command = commands.add_parser("build-atlas", help="build atlas.nii.gz from the propagated label maps")
+    addAtlasArguments(command)
+    command.add_argument("--per-label-images", action="store_true", help="read the binary per-label images of propagate --per-label-images")
+    command.set_defaults(function=buildAtlas)
+
+    command = commands.add_parser("mean-image", help="build meanImage.nii.gz")
+    addAtlasArguments(command)
+    command.add_argument("--variance", action="store_true", help="also store varianceImage.nii.gz")
+    command.set_defaults(function=meanImage)
+
+    command = commands.add_parser("build", help="register, propagate and build atlas and mean image in memory")
+    addAtlasArguments(command)
+    addPoolArguments(command)
+    command.add_argument("--retries", type=int, default=1)
+    command.add_argument("--cache", default=None, help="TransformCache folder")
+    command.add_argument("--checkpoint", action="store_true", help="also store transforms and propagated images")
+    command.set_defaults(function=build)
+
+    command = commands.add_parser("template", help="build a groupwise template by iterated registration, averaging and mean affine shape correction")
+    command.add_argument("--images", default="training-set/training-images")
+    command.add_argument("--parameters", default="Par0038")
+    command.add_argument("--masks", default=None, help="brain masks or label maps named after the images")
+    command.add_argument("--reference", default=None, help="starting image (default: the first image)")
+    command.add_argument("--output", default="template")
+    command.add_argument("--iterations", type=int, default=5)
+    command.add_argument("--tolerance", type=float, default=1e-3, help="stop once the template changes less (relative RMS)")
+    command.add_argument("--reuse-stages", type=int, default=None, help="stages kept from the previous iteration (default: all but the last)")
+    command.add_argument("--time-limit", type=float, default=None, help="hours, no iteration is started that would end later")
+    command.add_argument("--retries", type=int, default=1)
+    addPoolArguments(command)
+    command.set_defaults(function=template)
+
+    command = commands.add_parser("fuse", help="fuse label maps propagated into one target (majority, weighted or STAPLE)")
+    command.add_argument("labels", nargs="+", help="propagated label maps, all on the target grid")
+    command.add_argument("--method", choices=("majority", "weighted", "staple"), default="majority")
+    command.add_argument("--intensities", nargs="+", default=None, help="propagated atlas images in the order of the labels (weighted)")
+    command.add_argument("--target", default=None, help="target image (weighted)")
+    command.add_argument("--output", default="fusedLabels.nii.gz")
+    command.add_argument("--labels-count", type=int, default=3, help="highest label, larger labels count as background")
+    command.add_argument("--block-voxels", type=int, default=1 << 21, help="voxels per block over all atlases held by a worker")
+    command.add_argument("--store", default="volumeStore", help="VolumeStore folder the inputs are memory mapped from")
+    command.add_argument("--patch-radius", type=int, default=2)
+    command.add_argument("--power", type=float, default=1.0, help="weights are the inverse local MSE to this power")
+    command.add_argument("--iterations", type=int, default=30, help="STAPLE EM iterations at most")
+    command.add_argument("--workers", type=int, default=None)
+    command.set_defaults(function=fuse)
+
+    command = commands.add_parser("tissue-models", help="build TissueModel.csv and TissueModel.npz")
+    command.add_argument("--images", default="training-set/training-images/")
+    command.add_argument("--labels", default="training-set/training-labels/")
+    command.add_argument("--workers", type=int, default=None)
+    command.add_argument("--histograms", default="qc/tissueHistograms.npz", help="histograms for the qc command")
+    command.add_argument("--no-histograms", action="store_true")
+    command.set_defaults(function=tissueModels)
+
+    command = commands.add_parser("qc", help="render the quality control figures headless, after the compute commands")
+    command.add_argument("--images", default="training-set/training-images")
+    command.add_argument("--fixed", default="1010", help="name of the fixed image")
+    command.add_argument("--sections", nargs="+", choices=("histograms", "registration", "atlas"), default=None, help="default: all")
+    command.add_argument("--histograms", default="qc/tissueHistograms.npz")
+    command.add_argument("--atlas", default="atlas.nii.gz", help="any atlas format, e.g. atlas_sparse")
+    command.add_argument("--mean-image", default="meanImage.nii.gz")
+    command.add_argument("--output", default="qc")
+    command.add_argument("--dpi", type=int, default=100)
+    command.add_argument("--catalog", default=":memory:", help="sqlite file to keep the dataset index in between runs")
+    command.add_argument("--workers", type=int, default=None)
+    command.set_defaults(function=qcReport)
+
+    command = commands.add_parser("select-reference", help="find the image most similar to all others")
+    command.add_argument("--images", default="training-set/training-images")
+    command.add_argument("--fixed", default=None, help="image the others are registered to without --fast (default: the first by name)")
+    command.add_argument("--metric", choices=("mse", "ncc", "mi"), default="mse")
+    command.add_argument("--fast", action="store_true", help="low resolution screening, full resolution only for the top-k")
+    command.add_argument("--levels", type=int, default=2)
+    command.add_argument("--top-k", type=int, default=3)
+    command.add_argument("--downsample", type=int, default=1)
+    command.add_argument("--mask", default=None, help="brain mask of the fixed image, only voxels inside are compared")
+    command.add_argument("--workers", type=int, default=None)
+    command.set_defaults(function=selectReference)
+
+    command = commands.add_parser("segment", help="segment new scans with the atlas and the tissue model")
+    command.add_argument("scans", nargs="+")
+    command.add_argument("--output", default="segmentations")
+    command.add_argument("--threads", type=int, default=None)
+    addSegmentationArguments(command)
+    command.set_defaults(function=segment)
+
+    command = commands.add_parser("serve", help="run the segmentation service")
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=8750)
+    command.add_argument("--workers", type=int, default=2)
+    command.add_argument("--queue-size", type=int, default=8)
+    command.add_argument("--threads", type=int, default=None)
+    addSegmentationArguments(command)
+    command.set_defaults(function=serve)
+
+    command = commands.add_parser("benchmark", help="time the pipeline on synthetic phantoms and store the result per commit")
+    command.add_argument("--size", type=int, default=128, help="phantom edge length in voxels (128 to 512)")
+    command.add_argument("--subjects", type=int, default=4)
+    command.add_argument("--seed", type=int, default=0)
+    command.add_argument("--stages", nargs="+", default=None, help="subset of the stages, e.g. registration \"mean image\"")
+    command.add_argument("--parameters", default=None, help="elastix parameter folder (default: elastix default maps)")
+    command.add_argument("--workers", type=int, default=None)
+    command.add_argument("--work-folder", default="benchmarkData")
+    command.add_argument("--results", default="benchmarks")
+    command.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULT"), help="compare two stored results instead")
+    command.set_defaults(function=benchmark)
+    return parser
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    if args.volume_store is not None:
+        from utils import Utils
+        Utils.useVolumeStore(args.volume_store)
+    if args.profile is not None:
+        profiler.enable(profileCalls=args.call_profile is not None, traceMemory=args.trace_memory)
+
+    with profiler.stage(args.command):
+        args.function(args)
+
+    if args.profile is not None:
+        profiler.writeReport(args.profile, args.call_profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import os
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import uniform_filter
+
+from volumeStore import VolumeStore
+from profiling import profiler
+
+
+def initWorker(storeFolder, labelPaths, imagePaths, targetImagePath):
+    # opens the memory mapped inputs once per worker process
+    global workerData
+    store = VolumeStore(storeFolder)
+    workerData = {
+        "labels": [store.array(labelPath) for labelPath in labelPaths],
+        "images": [store.array(imagePath) for imagePath in imagePaths],
+        "target": None if targetImagePath is None else store.array(targetImagePath),
+    }
+
+
+def fuseBlock(task, start, stop, parameters):
+    # worker entry point: fuses the slab start:stop (last axis) of all atlases. Returns (start, stop, result).
+    # The atlases are read one at a time, so only one atlas slab is in memory next to the votes or posteriors
+    numberOfLabels = parameters["numberOfLabels"]
+    volumes = workerData["labels"]
+    if task in ("staple", "staple labels"):
+        posteriors = staplePosteriors(volumes, start, stop, numberOfLabels, parameters["theta"], parameters["prior"])
+        if task == "staple labels":
+            return start, stop, np.argmax(posteriors, axis=1).astype(np.uint16)
+        return start, stop, stapleStatistics(volumes, start, stop, numberOfLabels, posteriors)
+
+    target = targetSlab(start, stop, parameters) if task == "weighted" else None
+    votes = None
+    for atlas, volume in enumerate(volumes):
+        labels = readLabels(volume, start, stop, numberOfLabels)
+        if votes is None:
+            votes = np.zeros((numberOfLabels + 1, labels.size), dtype=np.float32)
+            voxelIndex = np.arange(labels.size)
+        votes[labels, voxelIndex] += 1 if target is None else localWeight(atlas, start, stop, target, parameters) # each voxel once per atlas
+    return start, stop, np.argmax(votes, axis=0).astype(np.uint16)
+
+
+def readLabels(volume, start, stop, numberOfLabels):
+    # the slab of one atlas as flat labels in the smallest unsigned type. Propagated float label maps are rounded to the
+    # nearest label, labels outside 0..numberOfLabels count as background
+    slab = np.asarray(volume[:, :, start:stop]).reshape(-1)
+    if not np.issubdtype(slab.dtype, np.integer):
+        slab = np.rint(slab)
+    dtype = np.uint8 if numberOfLabels <= np.iinfo(np.uint8).max else np.uint16
+    return np.where((slab >= 0) & (slab <= numberOfLabels), slab, 0).astype(dtype, copy=False)
+
+
+def targetSlab(start, stop, parameters):
+    # the z-scored target of the slab with a halo of patchRadius, so the local filter is exact. Returns (halo start, halo stop, target)
+    radius = parameters["patchRadius"]
+    depth = workerData["target"].shape[2]
+    haloStart, haloStop = max(start - radius, 0), min(stop + radius, depth)
+    targetMean, targetStd = parameters["targetStatistics"]
+    return haloStart, haloStop, (np.asarray(workerData["target"][:, :, haloStart:haloStop], dtype=np.float32) - targetMean) / targetStd
+
+
+def localWeight(atlas, start, stop, target, parameters):
+    # inverse local mean squared difference between the target and the atlas image over a cubic patch, flat over the slab.
+    # Intensities are z-scored per volume first
+    haloStart, haloStop, target = target
+    mean, std = parameters["imageStatistics"][atlas]
+    difference = (np.asarray(workerData["images"][atlas][:, :, haloStart:haloStop], dtype=np.float32) - mean) / std - target
+    localError = uniform_filter(np.square(difference), size=2 * parameters["patchRadius"] + 1, mode="nearest")
+    return np.power(localError[:, :, start - haloStart:stop - haloStart] + parameters["epsilon"], -parameters["power"]).reshape(-1)
+
+
+def staplePosteriors(volumes, start, stop, numberOfLabels, theta, prior):
+    # E-step: p(true label | all atlas decisions) per voxel (voxels x labels), computed in the log domain
+    logTheta = np.log(np.maximum(theta, 1e-12))
+    logPosteriors = None
+    for atlas, volume in enumerate(volumes):
+        labels = readLabels(volume, start, stop, numberOfLabels)
+        if logPosteriors is None:
+            logPosteriors = np.broadcast_to(np.log(prior), (labels.size, len(prior))).copy()
+        logPosteriors += logTheta[atlas][labels]
+    logPosteriors -= logPosteriors.max(axis=1, keepdims=True)
+    posteriors = np.exp(logPosteriors)
+    return posteriors / posteriors.sum(axis=1, keepdims=True)
+
+
+def stapleStatistics(volumes, start, stop, numberOfLabels, posteriors):
+    # M-step sums of the block: per atlas the posterior mass of every (decision, true label) pair, and the label votes
+    numberOfClasses = numberOfLabels + 1
+    statistics = np.zeros((len(volumes), numberOfClasses, numberOfClasses))
+    voteCounts = np.zeros(numberOfClasses, dtype=np.int64)
+    for atlas, volume in enumerate(volumes):
+        labels = readLabels(volume, start, stop, numberOfLabels)
+        for trueLabel in range(numberOfClasses):
+            statistics[atlas, :, trueLabel] = np.bincount(labels, weights=posteriors[:, trueLabel], minlength=numberOfClasses)
+        voteCounts += np.bincount(labels, minlength=numberOfClasses)
+    return statistics, voteCounts
+
+
+class LabelFusion:
+    # fuses N label maps propagated into the space of one target (multi-atlas segmentation):
+    #   majority   most frequent label per voxel
+    #   weighted   votes weighted by the local intensity similarity of atlas and target (inverse local MSE ** power)
+    #   staple     STAPLE (multi-label EM of one confusion matrix per atlas), one pass over all blocks per EM iteration
+    # The inputs are memory mapped from a VolumeStore and processed in slabs along the last axis on worker processes.
+    # A slab holds blockVoxels voxels over all atlases together (blockVoxels / N per atlas) and the atlases are read one
+    # at a time, so the memory of a worker does not grow with the number of atlases
+    methods = ("majority", "weighted", "staple")
+
+    def __init__(self, method="majority", numberOfLabels=3, numberOfWorkers=None, blockVoxels=1 << 21, storeFolder="volumeStore",
+                 patchRadius=2, power=1.0, stapleIterations=30, stapleTolerance=1e-4):
+        if method not in self.methods:
+            raise ValueError(f"Unknown fusion method {method}, choose one of {self.methods}")
+        self.method = method
+        self.numberOfLabels = numberOfLabels
+        self.numberOfWorkers = numberOfWorkers or os.cpu_count() or 1
+        self.blockVoxels = blockVoxels
+        self.store = VolumeStore(storeFolder)
+        self.patchRadius = patchRadius
+        self.power = power
+        self.stapleIterations = stapleIterations
+        self.stapleTolerance = stapleTolerance
+
+    def fuseToFile(self, labelPaths, outputPath, imagePaths=(), targetImagePath=None):
+        # stores the fused label map with the geometry of the target (or the first label map)
+        fusedLabels = self.fuse(labelPaths, imagePaths, targetImagePath)
+        dtype = np.uint8 if self.numberOfLabels <= np.iinfo(np.uint8).max else np.uint16
+        affine = self.store.affine(targetImagePath or labelPaths[0])
+        nib.Nifti1Image(fusedLabels.astype(dtype), affine).to_filename(outputPath)
+        return outputPath
+
+    def fuse(self, labelPaths, imagePaths=(), targetImagePath=None):
+        # returns the fused label map in nibabel (x, y, z) order. imagePaths (the propagated atlas intensities, in the
+        # order of labelPaths) and targetImagePath are only needed for weighted voting
+        if self.method == "weighted" and (len(imagePaths) != len(labelPaths) or targetImagePath is None):
+            raise ValueError("Weighted voting needs one propagated image per label map and the target image")
+        imagePaths = list(imagePaths) if self.method == "weighted" else []
+        targetImagePath = targetImagePath if self.method == "weighted" else None
+
+        with profiler.stage("fusion convert", atlases=len(labelPaths)):
+            shapes = {tuple(self.store.convert(path)["shape"][:3]) for path in labelPaths + imagePaths + [targetImagePath] if path is not None}
+        if len(shapes) != 1:
+            raise ValueError(f"All volumes must share the target grid, found shapes {sorted(shapes)}")
+        self.shape = shapes.pop()
+        self.numberOfAtlases = len(labelPaths)
+
+        parameters = {"numberOfLabels": self.numberOfLabels}
+        if self.method == "weighted":
+            parameters.update(self.weightParameters(imagePaths, targetImagePath))
+        arguments = (self.store.storeFolder, labelPaths, imagePaths, targetImagePath)
+        with profiler.stage(f"fusion {self.method}", atlases=len(labelPaths)), \
+                ProcessPoolExecutor(self.numberOfWorkers, initializer=initWorker, initargs=arguments) as executor:
+            if self.method == "staple":
+                return self.staple(executor, len(labelPaths), parameters)
+            return self.fuseBlocks(executor, self.method, parameters)
+
+    def blocks(self):
+        # slabs along the last (slowest, contiguous in the store) axis with about blockVoxels voxels over all atlases
+        depth = self.shape[2]
+        thickness = max(1, self.blockVoxels // max(self.shape[0] * self.shape[1] * self.numberOfAtlases, 1))
+        return [(start, min(start + thickness, depth)) for start in range(0, depth, thickness)]
+
+    def runBlocks(self, executor, task, parameters):
+        blocks = self.blocks()
+        starts, stops = zip(*blocks)
+        return executor.map(fuseBlock, [task] * len(blocks), starts, stops, [parameters] * len(blocks))
+
+    def fuseBlocks(self, executor, task, parameters):
+        fusedLabels = np.zeros(self.shape, dtype=np.uint16)
+        for start, stop, blockLabels in self.runBlocks(executor, task, parameters):
+            fusedLabels[:, :, start:stop] = blockLabels.reshape(self.shape[0], self.shape[1], stop - start)
+        return fusedLabels
+
+    def weightParameters(self, imagePaths, targetImagePath):
+        # global mean and standard deviation of every volume, for the z-scores of the local similarity
+        def statistics(path):
+            array = self.store.array(path)
+            mean = float(np.mean(array, dtype=np.float64))
+            return mean, max(float(np.std(array, dtype=np.float64)), 1e-6)
+        return {"patchRadius": self.patchRadius, "power": self.power, "epsilon": 1e-3,
+                "targetStatistics": statistics(targetImagePath), "imageStatistics": [statistics(path) for path in imagePaths]}
+
+    def staple(self, executor, numberOfAtlases, parameters):
+        # EM over the blocks: every iteration sums the M-step statistics of all blocks, the prior is the label
+        # frequency over all atlases (taken from the first pass)
+        numberOfClasses = self.numberOfLabels + 1
+        theta = np.full((numberOfAtlases, numberOfClasses, numberOfClasses), 0.1 / max(numberOfClasses - 1, 1))
+        theta[:, np.arange(numberOfClasses), np.arange(numberOfClasses)] = 0.9
+        prior = np.full(numberOfClasses, 1 / numberOfClasses)
+
+        for iteration in range(self.stapleIterations):
+            statistics = np.zeros_like(theta)
+            voteCounts = np.zeros(numberOfClasses)
+            for _, _, (blockStatistics, blockVotes) in self.runBlocks(executor, "staple", {**parameters, "theta": theta, "prior": prior}):
+                statistics += blockStatistics
+                voteCounts += blockVotes
+            if iteration == 0:
+                prior = np.maximum(voteCounts / voteCounts.sum(), 1e-12)
+            newTheta = statistics / np.maximum(statistics.sum(axis=1, keepdims=True), 1e-12)
+            change = np.abs(newTheta - theta).max()
+            theta = newTheta
+            if change < self.stapleTolerance:
+                break
+
+        self.theta = theta # per atlas confusion matrices p(decision | true label), the diagonal is the sensitivity
+        return self.fuseBlocks(executor, "staple labels", {**parameters, "theta": theta, "prior": prior})
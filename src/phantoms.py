@@ -0,0 +1,109 @@
+import os
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import map_coordinates, zoom, gaussian_filter
+
+from utils import Utils
+
+
+class PhantomGenerator:
+    # synthetic brain-like phantoms for benchmarks: nested ellipsoids of CSF, GM and WM with ventricles,
+    # noise and a smooth bias field. Every subject is the template warped by a known random affine plus
+    # smooth displacement field (stored as <id>_deformation.npy). Labels follow the training set:
+    # 1 = CSF, 2 = WM, 3 = GM (columns of TissueModel.csv)
+    util = Utils()
+    intensities = {1: 30.0, 2: 110.0, 3: 80.0}
+
+    def __init__(self, size=128, seed=0, displacement=4.0, spacing=1.0):
+        self.size = size
+        self.seed = seed
+        self.displacement = displacement # maximum amplitude in voxels
+        self.spacing = spacing
+
+    def generate(self, rootFolder, numberOfSubjects, firstId=1000):
+        # writes <rootFolder>/training-set/training-images/<id>.nii.gz and training-labels/<id>_3C.nii.gz
+        imageFolder = os.path.join(rootFolder, "training-set", "training-images")
+        labelFolder = os.path.join(rootFolder, "training-set", "training-labels")
+        deformationFolder = os.path.join(rootFolder, "training-set", "deformations")
+        for folder in (imageFolder, labelFolder, deformationFolder):
+            self.util.ensureFolderExists(folder)
+
+        template = self.templateLabels()
+        affine = np.diag([self.spacing, self.spacing, self.spacing, 1.0])
+        for index in range(numberOfSubjects):
+            subjectId = str(firstId + index)
+            rng = np.random.default_rng((self.seed, index))
+            coordinates = self.deformation(rng) if index > 0 else None # the first subject is the undeformed template
+            labels = template if coordinates is None else map_coordinates(template, coordinates, order=0)
+            image = self.intensityImage(labels, rng)
+
+            nib.Nifti1Image(image, affine).to_filename(os.path.join(imageFolder, f"{subjectId}.nii.gz"))
+            nib.Nifti1Image(labels, affine).to_filename(os.path.join(labelFolder, f"{subjectId}_3C.nii.gz"))
+            if coordinates is not None:
+                np.save(os.path.join(deformationFolder, f"{subjectId}_deformation.npy"), coordinates)
+        return imageFolder, labelFolder
+
+    ######################################################
+    ### Anatomy ##########################################
+    ######################################################
+
+    def templateLabels(self):
+        # nested ellipsoids: CSF shell, GM shell, WM core and two CSF ventricles
+        grid = (np.indices((self.size,) * 3, dtype=np.float32) - (self.size - 1) / 2) / (self.size / 2)
+        radii = np.array([0.72, 0.85, 0.65], dtype=np.float32)[:, np.newaxis, np.newaxis, np.newaxis]
+        distance = np.sqrt(np.sum(np.square(grid / radii), axis=0))
+
+        labels = np.zeros(distance.shape, dtype=np.uint8)
+        labels[distance < 1.0] = 1
+        labels[distance < 0.92] = 3
+        labels[distance < 0.7] = 2
+        for side in (-1, 1):
+            ventricle = np.square((grid[0] - side * 0.12) / 0.06) + np.square(grid[1] / 0.25) + np.square(grid[2] / 0.1)
+            labels[ventricle < 1] = 1
+        return labels
+
+    def intensityImage(self, labels, rng):
+        # T1-like contrast with a smooth multiplicative bias field and gaussian noise
+        image = np.zeros(labels.shape, dtype=np.float32)
+        for label, intensity in self.intensities.items():
+            image[labels == label] = intensity
+        bias = 1 + 0.1 * self.smoothField(rng, labels.shape)
+        image *= bias
+        image += rng.normal(0, 4, labels.shape).astype(np.float32)
+        return np.clip(image, 0, None)
+
+    ######################################################
+    ### Known Deformations ###############################
+    ######################################################
+
+    def deformation(self, rng):
+        # sampling coordinates (3, x, y, z): a small random affine plus a smooth displacement field
+        shape = (self.size,) * 3
+        center = (self.size - 1) / 2
+        angles = rng.uniform(-0.05, 0.05, 3)
+        scale = rng.uniform(0.95, 1.05, 3)
+        translation = rng.uniform(-2, 2, 3)
+        matrix = self.rotation(angles) @ np.diag(scale)
+
+        grid = np.indices(shape, dtype=np.float32).reshape(3, -1) - center
+        coordinates = (matrix @ grid).astype(np.float32) + (center + translation)[:, np.newaxis].astype(np.float32)
+        coordinates = coordinates.reshape((3,) + shape)
+        for axis in range(3):
+            coordinates[axis] += self.displacement * self.smoothField(rng, shape)
+        return coordinates
+
+    @staticmethod
+    def smoothField(rng, shape, controlPoints=6):
+        # random field in [-1, 1] interpolated from a coarse grid
+        coarse = rng.uniform(-1, 1, (controlPoints,) * 3)
+        field = zoom(gaussian_filter(coarse, 1), [size / controlPoints for size in shape], order=3)
+        return np.clip(field[tuple(slice(0, size) for size in shape)], -1, 1).astype(np.float32)
+
+    @staticmethod
+    def rotation(angles):
+        cx, cy, cz = np.cos(angles)
+        sx, sy, sz = np.sin(angles)
+        rotationX = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+        rotationY = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+        rotationZ = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+        return rotationZ @ rotationY @ rotationX
@@ -0,0 +1,154 @@
+import os
+import csv
+import json
+import time
+import resource
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Profiler:
+    # records wall time, cpu time and memory per pipeline stage (and subject) and writes them as a json or csv
+    # run report. A disabled profiler records nothing, so the instrumented code runs unchanged by default.
+    # Optional hooks: cProfile for the whole run and tracemalloc for the peak python allocations per stage.
+    # Peaks are per stage: the high-water marks are reset when a stage starts (on Linux via /proc/self/clear_refs)
+    # and folded into all enclosing stages before every reset, so nested stages do not hide the peaks of outer ones.
+    # Without a resettable RSS high-water mark only the process lifetime peak is recorded, as processPeakRssMb
+
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.cProfiler = None
+        self.traceMemory = False
+        self.openStages = [] # running peaks of the stages that are currently open, innermost last
+        self.resettableRss = None
+
+    def enable(self, profileCalls=False, traceMemory=False):
+        self.enabled = True
+        self.traceMemory = traceMemory
+        self.resettableRss = self.resetPeakRss()
+        if traceMemory:
+            tracemalloc.start()
+        if profileCalls:
+            self.cProfiler = cProfile.Profile()
+            self.cProfiler.enable()
+
+    @contextmanager
+    def stage(self, name, subject=None, **details):
+        # times the enclosed block. The yielded dict can be filled with more details while the stage runs
+        record = {"stage": name, "subject": subject, **details}
+        if not self.enabled:
+            yield record
+            return
+
+        self.checkpointPeaks()
+        self.resetPeaks()
+        peaks = {"rss": self.currentRss() or 0.0, "traced": 0.0}
+        self.openStages.append(peaks)
+        wallStart, cpuStart = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record["wallTime"] = time.perf_counter() - wallStart
+            record["cpuTime"] = time.process_time() - cpuStart
+            record["rssMb"] = self.currentRss()
+            self.checkpointPeaks()
+            self.openStages = [openPeaks for openPeaks in self.openStages if openPeaks is not peaks] # by identity, equal peaks are common
+            if self.resettableRss:
+                record["peakRssMb"] = peaks["rss"]
+            else:
+                record["processPeakRssMb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on Linux
+            if self.traceMemory:
+                record["peakTracedMb"] = peaks["traced"]
+            record["pid"] = os.getpid()
+            self.records.append(record)
+
+    def checkpointPeaks(self):
+        # folds the high-water marks since the last reset into every open stage
+        rssPeak = self.peakRss() if self.resettableRss else None
+        tracedPeak = tracemalloc.get_traced_memory()[1] / 2**20 if self.traceMemory else None
+        for peaks in self.openStages:
+            if rssPeak is not None:
+                peaks["rss"] = max(peaks["rss"], rssPeak)
+            if tracedPeak is not None:
+                peaks["traced"] = max(peaks["traced"], tracedPeak)
+
+    def resetPeaks(self):
+        if self.resettableRss:
+            self.resetPeakRss()
+        if self.traceMemory:
+            tracemalloc.reset_peak()
+
+    @staticmethod
+    def resetPeakRss():
+        # resets the RSS high-water mark (VmHWM) to the current RSS. Returns False where that is not possible
+        try:
+            with open("/proc/self/clear_refs", "w") as file:
+                file.write("5")
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def peakRss():
+        # RSS high-water mark since the last reset in MB
+        try:
+            with open("/proc/self/status") as file:
+                for line in file:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024 # kB
+        except OSError:
+            pass
+        return None
+
+    @staticmethod
+    def currentRss():
+        # resident set size of this process in MB
+        try:
+            with open("/proc/self/statm") as file:
+                return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+        except OSError:
+            return None
+
+    @staticmethod
+    def describeTransforms(parameterMaps):
+        # transform type and size of every elastix stage, taken from the result parameter maps
+        keys = ("Transform", "NumberOfParameters", "NumberOfResolutions", "MaximumNumberOfIterations")
+        return [{key: " ".join(parameterMap[key]) for key in keys if key in parameterMap} for parameterMap in parameterMaps]
+
+    ######################################################
+    ### Reports ##########################################
+    ######################################################
+
+    def writeReport(self, reportPath, callProfilePath=None):
+        # writes the records as json (default) or csv (.csv) and, with cProfile enabled, the call statistics
+        if reportPath.endswith(".csv"):
+            columns = []
+            for record in self.records:
+                columns += [key for key in record if key not in columns]
+            with open(reportPath, "w", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=columns)
+                writer.writeheader()
+                for record in self.records:
+                    writer.writerow({key: json.dumps(value) if isinstance(value, (list, dict)) else value for key, value in record.items()})
+        else:
+            with open(reportPath, "w") as file:
+                json.dump({"records": self.records, "summary": self.summary()}, file, indent=2)
+
+        if self.cProfiler is not None and callProfilePath is not None:
+            self.cProfiler.disable()
+            self.cProfiler.dump_stats(callProfilePath)
+
+    def summary(self):
+        # total wall and cpu time per stage
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["stage"], {"count": 0, "wallTime": 0.0, "cpuTime": 0.0})
+            total["count"] += 1
+            total["wallTime"] += record["wallTime"]
+            total["cpuTime"] += record["cpuTime"]
+        return totals
+
+
+profiler = Profiler() # shared by all modules, enabled by the command line
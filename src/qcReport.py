@@ -0,0 +1,200 @@
+import os
+import numpy as np
+import matplotlib
+matplotlib.use("Agg") # headless, figures are only written to files
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import Utils
+from catalog import DatasetCatalog
+from atlasFormats import AtlasReader
+from profiling import profiler
+
+colors = ['red', 'green', 'blue']
+
+
+######################################################
+### Figures ##########################################
+######################################################
+
+def renderFigure(kind, inputs, outputPath, dpi):
+    # worker entry point: renders one figure to outputPath. Returns outputPath
+    figure = renderers[kind](**inputs)
+    figure.savefig(outputPath, dpi=dpi)
+    plt.close(figure) # workers render many figures, pyplot would keep them all alive
+    return outputPath
+
+
+def plotCurves(histogramPath, curves, title, name_axisy, zoom=None):
+    # one curve per tissue over the 8-bit intensities, zoom = (x1, x2, y1, y2) adds an inset
+    with np.load(histogramPath) as arrays:
+        histograms, edges, labels = arrays[curves], arrays["edges"], [str(label) for label in arrays["labels"]]
+    figure, main_ax = plt.subplots(figsize=(10, 5))
+    for i, hist in enumerate(histograms):
+        main_ax.plot(edges[:-1], hist, color=colors[i % len(colors)], label=labels[i])
+
+    main_ax.set_title(title)
+    main_ax.set_xlabel('Pixel Intensity')
+    main_ax.set_ylabel(name_axisy)
+    main_ax.legend(loc='upper right')
+    main_ax.set_xlim([0, 255])
+    main_ax.grid(True, which='both', linestyle='--', linewidth=0.5)
+
+    if zoom is not None:
+        x1, x2, y1, y2 = zoom
+        axins = main_ax.inset_axes([0.07, 0.7, 0.2, 0.2])
+        for i, hist in enumerate(histograms):
+            axins.plot(edges[:-1], hist, color=colors[i % len(colors)])
+        axins.set_xlim(x1, x2)
+        axins.set_ylim(y1, y2)
+        main_ax.indicate_inset_zoom(axins)
+
+    figure.tight_layout()
+    return figure
+
+
+def plotRegistration(fixedImagePath, imagePath, labelPath=None, subject=""):
+    # fixed image in magenta and the registered image in green (gray where they agree) on the three central slices,
+    # with the contours of the propagated labels
+    util = Utils()
+    fixed = normalizedSlices(util.readNiftiImage(fixedImagePath)[0])
+    moving = normalizedSlices(util.readNiftiImage(imagePath)[0])
+    labels = None if labelPath is None else centralSlices(util.readNiftiImage(labelPath)[0])
+
+    figure, axes = plt.subplots(1, 3, figsize=(12, 4))
+    for axis, ax in enumerate(axes):
+        ax.imshow(np.stack([fixed[axis], moving[axis], fixed[axis]], axis=-1))
+        if labels is not None and labels[axis].max() > 0:
+            ax.contour(labels[axis], levels=np.arange(0.5, labels[axis].max()), colors='yellow', linewidths=0.5)
+        ax.set_xticks([])
+        ax.set_yticks([])
+    axes[0].set_title(f'Case {subject}')
+    figure.tight_layout()
+    return figure
+
+
+def plotAtlas(atlasPath, meanImagePath=None):
+    # central slices of every label of the atlas (one row per label) and of the mean image
+    atlas = AtlasReader(atlasPath)
+    rows = [(f'Label {label}', [np.rot90(np.squeeze(atlas.probability(label, region))) for region in centralRegions(atlas.shape)], 'viridis')
+            for label in range(1, atlas.numberOfLabels + 1)]
+    if meanImagePath is not None:
+        rows.insert(0, ('Mean image', normalizedSlices(Utils().readNiftiImage(meanImagePath)[0]), 'gray'))
+
+    figure, axes = plt.subplots(len(rows), 3, figsize=(9, 3 * len(rows)), squeeze=False)
+    for (title, slices, colormap), rowAxes in zip(rows, axes):
+        for ax, image in zip(rowAxes, slices):
+            ax.imshow(image, cmap=colormap)
+            ax.set_xticks([])
+            ax.set_yticks([])
+        rowAxes[0].set_ylabel(title)
+    figure.tight_layout()
+    return figure
+
+
+renderers = {"curves": plotCurves, "registration": plotRegistration, "atlas": plotAtlas}
+
+
+def centralRegions(shape):
+    # one single slice region through the centre per axis, in nifti (x, y, z) order
+    regions = []
+    for axis, size in enumerate(shape[:3]):
+        region = [slice(None)] * 3
+        region[axis] = slice(size // 2, size // 2 + 1)
+        regions.append(tuple(region))
+    return regions
+
+
+def centralSlices(volume):
+    return [np.rot90(np.squeeze(np.asarray(volume[region]))) for region in centralRegions(volume.shape)]
+
+
+def normalizedSlices(volume):
+    # central slices scaled to 0..1 with the robust range of the slices
+    slices = centralSlices(volume)
+    low, high = np.percentile(np.concatenate([image.ravel() for image in slices]), [1, 99])
+    return [np.clip((image - low) / max(high - low, 1e-12), 0, 1) for image in slices]
+
+
+class QcReport:
+    # renders the quality control figures on worker processes, after and independent of the compute stages:
+    #   tissue histograms  from the histograms TissueModels.execute stores (qc/tissueHistograms.npz)
+    #   registration       one overlay of the fixed and the registered image (with label contours) per subject
+    #   atlas              central slices of the atlas labels and the mean image
+    # Inputs that do not exist (yet) are skipped, so the report can run at any point or not at all
+    util = Utils()
+    sections = ("histograms", "registration", "atlas")
+
+    def __init__(self, outputFolder="qc", dpi=100, numberOfWorkers=None, catalog=None):
+        self.outputFolder = outputFolder
+        self.dpi = dpi
+        self.numberOfWorkers = numberOfWorkers
+        self.catalog = catalog or DatasetCatalog()
+
+    def run(self, fixedImagePath=None, histogramPath="qc/tissueHistograms.npz", atlasPath="atlas.nii.gz", meanImagePath="meanImage.nii.gz",
+            sections=None):
+        # returns the paths of the rendered figures
+        sections = self.sections if sections is None else sections
+        tasks = []
+        if "histograms" in sections:
+            tasks += self.histogramTasks(histogramPath)
+        if "registration" in sections:
+            tasks += self.registrationTasks(fixedImagePath)
+        if "atlas" in sections:
+            tasks += self.atlasTasks(atlasPath, meanImagePath)
+        return self.render(tasks)
+
+    def render(self, tasks):
+        # tasks: (kind, inputs, output name) tuples
+        if not tasks:
+            return []
+        kinds, inputs, names = zip(*tasks)
+        outputPaths = [os.path.join(self.outputFolder, name) for name in names]
+        for folder in {os.path.dirname(outputPath) for outputPath in outputPaths}:
+            self.util.ensureFolderExists(folder)
+        with profiler.stage("qc report", figures=len(tasks), dpi=self.dpi), ProcessPoolExecutor(self.numberOfWorkers) as executor:
+            return list(executor.map(renderFigure, kinds, inputs, outputPaths, [self.dpi] * len(tasks)))
+
+    ######################################################
+    ### Tasks ############################################
+    ######################################################
+
+    @staticmethod
+    def histogramTasks(histogramPath):
+        if histogramPath is None or not os.path.exists(histogramPath):
+            return []
+        return [
+            ("curves", {"histogramPath": histogramPath, "curves": "distributionNorm", "title": 'Probability Density Function of Each Tissue',
+                        "name_axisy": 'p(X)'}, "Distribution_Norm.jpeg"),
+            ("curves", {"histogramPath": histogramPath, "curves": "probabilities", "title": 'Intensity Tissue Probabilities',
+                        "name_axisy": 'p(X|Tissue)'}, "ProbabilityHistogram.jpeg"),
+            ("curves", {"histogramPath": histogramPath, "curves": "distribution", "title": 'Histograms of Tissue Intensities',
+                        "name_axisy": 'Pixel Count', "zoom": (0, 100, 0, 5000)}, "Distribution.jpeg"),
+        ]
+
+    def registrationTasks(self, fixedImagePath):
+        # one overlay per subject with a propagated image
+        if fixedImagePath is None:
+            return []
+        self.catalog.refresh()
+        tasks = []
+        for subject in self.catalog.subjects("propagated image"):
+            inputs = {"fixedImagePath": fixedImagePath, "imagePath": self.catalog.path("propagated image", subject),
+                      "labelPath": self.catalog.path("propagated label", subject), "subject": subject}
+            tasks.append(("registration", inputs, os.path.join("registration", f"{subject}.jpeg")))
+        return tasks
+
+    @staticmethod
+    def atlasTasks(atlasPath, meanImagePath):
+        if atlasPath is None or not os.path.exists(atlasPath):
+            return []
+        meanImagePath = meanImagePath if meanImagePath is not None and os.path.exists(meanImagePath) else None
+        return [("atlas", {"atlasPath": atlasPath, "meanImagePath": meanImagePath}, "atlas.jpeg")]
+
+
+if __name__ == "__main__":
+    util = Utils()
+
+    imagePaths = util.getAllFiles("training-set/training-images")
+    fixedImagePath, _ = util.splitFixedFromMoving(imagePaths, "1010")
+    QcReport().run(fixedImagePath)
@@ -0,0 +1,73 @@
+import numpy as np
+from scipy.ndimage import affine_transform
+
+from utils import Utils
+from similarityMatrix import SimilarityMatrix
+
+
+class ReferenceSelector:
+    # cheap screening for the reference (fixed) image: all images are downsampled by 2**levels, aligned by
+    # their intensity moments instead of a registration and compared with a SimilarityMatrix.
+    # Only the topK best candidates need a full resolution comparison afterwards
+    util = Utils()
+    alignments = ("centroid", "moments")
+
+    def __init__(self, levels=2, topK=3, metric="ncc", alignment="centroid"):
+        if alignment not in self.alignments:
+            raise ValueError(f"Unknown alignment {alignment}, choose one of {self.alignments}")
+        self.levels = levels
+        self.topK = topK
+        self.metric = metric
+        self.alignment = alignment
+
+    def screen(self, imagePaths):
+        # returns the topK candidate paths (best first) and the low resolution similarity matrix
+        coarseImages = [self.align(self.downsample(self.util.loadImageFrom(imagePath))) for imagePath in imagePaths]
+
+        similarity = SimilarityMatrix(self.metric)
+        similarityMatrix = similarity.compute(coarseImages)
+        meanSimilarity = (similarityMatrix.sum(axis=1) - np.diag(similarityMatrix)) / max(len(imagePaths) - 1, 1)
+        ranking = np.argsort(meanSimilarity if self.metric == "mse" else -meanSimilarity)
+        finalists = [imagePaths[index] for index in ranking[:self.topK]]
+        return finalists, similarityMatrix
+
+    ######################################################
+    ### Downsampling #####################################
+    ######################################################
+
+    def downsample(self, image):
+        # block mean over (2**levels)^3 voxels
+        array = np.asarray(image, dtype=np.float32)
+        factor = 2 ** self.levels
+        shape = [size // factor for size in array.shape]
+        trimmed = array[tuple(slice(0, size * factor) for size in shape)]
+        blocks = trimmed.reshape(shape[0], factor, shape[1], factor, shape[2], factor)
+        return blocks.mean(axis=(1, 3, 5))
+
+    ######################################################
+    ### Moment Based Alignment ###########################
+    ######################################################
+
+    def align(self, image):
+        # moves the intensity centroid to the volume center ("moments" also rotates the principal axes onto the grid axes)
+        centroid, axes = self.moments(image)
+        if self.alignment == "centroid":
+            axes = np.eye(3)
+        center = (np.array(image.shape) - 1) / 2
+        # output voxel o samples the input at axes @ (o - center) + centroid
+        return affine_transform(image, axes, offset=centroid - axes @ center, order=1)
+
+    @staticmethod
+    def moments(image):
+        # intensity weighted centroid and principal axes (columns, largest variance first)
+        weights = np.clip(image, 0, None).ravel().astype(np.float64)
+        total = weights.sum() or 1
+        grid = np.indices(image.shape).reshape(3, -1).astype(np.float64)
+        centroid = grid @ weights / total
+        centered = grid - centroid[:, np.newaxis]
+        covariance = (centered * weights) @ centered.T / total
+
+        _, eigenvectors = np.linalg.eigh(covariance)
+        axes = eigenvectors[:, ::-1]
+        largestComponents = axes[np.argmax(np.abs(axes), axis=0), np.arange(3)]
+        return centroid, axes * np.sign(largestComponents) # consistent signs across images
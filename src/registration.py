@@ -3,13 +3,16 @@ import numpy as np
 import os
 
 from utils import Utils
+from profiling import profiler
 
 class Registration:
 
     util = Utils()
 
-    def __init__(self, parameterFolder):
-        self.parameterObject, self.registrationTypeList = self.initParamaterObject(parameterFolder)
+    def __init__(self, parameterFolder, cache=None, staged=False):
+        self.parameterObject, self.registrationTypeList, self.parameterPaths = self.initParamaterObject(parameterFolder)
+        self.cache = cache # optional TransformCache
+        self.staged = staged # one elastix call per stage, so finished stages can be reused
 
     def initParamaterObject(self, parameterFolder):
         # initializes a parameter object with the registration in the parameter Folder. Automatically sorted after rigid -> affine -> bspline
@@ -21,26 +24,131 @@ class Registration:
         for parameterPath in sortedMaps:
             parameterObject.AddParameterFile(parameterPath)
             registrationTypeList.append(os.path.basename(parameterPath).split(".")[0])
-        return parameterObject, registrationTypeList
-
-    def register(self, fixedImagePath, movingImagePath):
-        # registers an image
-        fixedImage = self.util.loadImageFrom(fixedImagePath)
-        movingImage = self.util.loadImageFrom(movingImagePath)
-        resultImage, resultTransformParameters = itk.elastix_registration_method(fixedImage, movingImage, parameter_object=self.parameterObject, log_to_console=False)
-        self.safeTransformParameterObject(resultTransformParameters, movingImagePath)
+        return parameterObject, registrationTypeList, sortedMaps
+
+    def register(self, fixedImagePath, movingImagePath, numberOfThreads=None, storeTransforms=True, initialTransformParameters=None, firstStage=0,
+                 fixedMaskPath=None, movingMaskPath=None):
+        # registers an image. numberOfThreads limits the elastix threads (None = elastix default).
+        # initialTransformParameters holds the result of the stages before firstStage, only the remaining stages are run.
+        # Brain masks (label maps work as well) restrict the metric sampling to the brain, background voxels are skipped
+        maskPaths = (fixedMaskPath, movingMaskPath)
+        if self.staged or initialTransformParameters is not None:
+            resultTransformParameters = self.registerStages(fixedImagePath, movingImagePath, numberOfThreads, initialTransformParameters, firstStage, maskPaths)
+        else:
+            resultTransformParameters = self.registerAllStages(fixedImagePath, movingImagePath, numberOfThreads, maskPaths)
+
+        if storeTransforms:
+            self.safeTransformParameterObject(resultTransformParameters, movingImagePath)
         #itk.imwrite(resultImage,"test/registeredImage.nii.gz")
-
-    def safeTransformParameterObject(self, resultTransformParameters, movingImagePath):
-        # saves the computed registration parameter file
+        return resultTransformParameters
+
+    def registerAllStages(self, fixedImagePath, movingImagePath, numberOfThreads, maskPaths=(None, None)):
+        # runs all stages in a single elastix call
+        stageKeys = None
+        if self.cache is not None:
+            stageKeys = self.cache.stageKeys(fixedImagePath, movingImagePath, self.parameterPaths, maskPaths)
+            resultTransformParameters = self.cache.get(stageKeys) # a hit skips elastix entirely
+            if resultTransformParameters is not None:
+                return resultTransformParameters
+
+        subject = os.path.basename(movingImagePath).split(".")[0]
+        with profiler.stage("read images", subject):
+            fixedImage = self.util.loadImageFrom(fixedImagePath)
+            movingImage = self.util.loadImageFrom(movingImagePath)
+            fixedMask, movingMask = self.loadMasks(maskPaths)
+        with profiler.stage("elastix", subject) as record:
+            resultTransformParameters = self.registerImages(fixedImage, movingImage, numberOfThreads, fixedMask, movingMask)
+            if profiler.enabled:
+                record["transforms"] = profiler.describeTransforms(self.util.parameterObjectToMaps(resultTransformParameters))
+        if stageKeys is not None:
+            self.cache.put(stageKeys, resultTransformParameters)
+        return resultTransformParameters
+
+    def registerImages(self, fixedImage, movingImage, numberOfThreads=None, fixedMask=None, movingMask=None):
+        # runs all stages on already loaded images, e.g. to reuse a preloaded atlas
+        resultImage, resultTransformParameters = itk.elastix_registration_method(fixedImage, movingImage, parameter_object=self.parameterObject, log_to_console=False, **self.threadArguments(numberOfThreads), **self.maskArguments(fixedMask, movingMask))
+        return resultTransformParameters
+
+    def registerStages(self, fixedImagePath, movingImagePath, numberOfThreads, initialTransformParameters=None, firstStage=0, maskPaths=(None, None)):
+        # runs the stages one after another, each initialized with the result of the previous ones.
+        # Without an explicit initial transform the longest cached prefix of stages is reused
+        stageKeys = None
+        if self.cache is not None and initialTransformParameters is None:
+            stageKeys = self.cache.stageKeys(fixedImagePath, movingImagePath, self.parameterPaths, maskPaths)
+            cachedStages = self.cache.cachedStages(stageKeys)
+            cachedTransformParameters = self.cache.get(stageKeys[:cachedStages]) if cachedStages > firstStage else None
+            if cachedTransformParameters is not None:
+                initialTransformParameters, firstStage = cachedTransformParameters, cachedStages
+
+        resultMaps = [] if initialTransformParameters is None else self.util.parameterObjectToMaps(initialTransformParameters)
+        if len(resultMaps) != firstStage:
+            raise ValueError(f"The initial transform has {len(resultMaps)} stages, but registration starts at stage {firstStage}")
+        if firstStage == len(self.parameterPaths):
+            return self.util.parameterObjectFromMaps(resultMaps)
+
+        subject = os.path.basename(movingImagePath).split(".")[0]
+        with profiler.stage("read images", subject):
+            fixedImage = self.util.loadImageFrom(fixedImagePath)
+            movingImage = self.util.loadImageFrom(movingImagePath)
+            maskArguments = self.maskArguments(*self.loadMasks(maskPaths))
+        for stage in range(firstStage, len(self.parameterPaths)):
+            stageParameterObject = itk.ParameterObject.New()
+            stageParameterObject.AddParameterMap(self.parameterObject.GetParameterMap(stage))
+            initialArguments = {}
+            if resultMaps:
+                initialArguments["initial_transform_parameter_object"] = self.util.parameterObjectFromMaps(resultMaps)
+
+            with profiler.stage(f"elastix {self.registrationTypeList[stage]}", subject) as record:
+                resultImage, stageTransformParameters = itk.elastix_registration_method(fixedImage, movingImage, parameter_object=stageParameterObject, log_to_console=False, **self.threadArguments(numberOfThreads), **maskArguments, **initialArguments)
+                stageMap = self.util.parameterObjectToMaps(stageTransformParameters)[-1] # the map of this stage comes last
+                record["transforms"] = profiler.describeTransforms([stageMap])
+            resultMaps.append(stageMap)
+            if stageKeys is not None:
+                self.cache.put(stageKeys, self.util.parameterObjectFromMaps([stageMap]), firstStage=stage)
+        return self.util.parameterObjectFromMaps(resultMaps)
+
+    def loadStoredStages(self, movingImagePath, numberOfStages):
+        # loads the first numberOfStages transforms stored by safeTransformParameterObject, e.g. as initial transform for a bspline sweep
+        imageName = os.path.basename(movingImagePath).split(".")[0]
+        matrixPaths = []
+        for registrationType in self.registrationTypeList[:numberOfStages]:
+            matrixPaths.append(os.path.join("transformationMatrices", imageName + "_" + registrationType + ".txt"))
+        return self.util.loadTransformParameterObject(matrixPaths)
+
+    @staticmethod
+    def threadArguments(numberOfThreads):
+        return {} if numberOfThreads is None else {"number_of_threads": numberOfThreads}
+
+    def loadMasks(self, maskPaths):
+        return [None if maskPath is None else self.util.loadMaskFrom(maskPath) for maskPath in maskPaths]
+
+    @staticmethod
+    def maskArguments(fixedMask, movingMask):
+        # elastix only samples the metric where the masks are set
+        arguments = {}
+        if fixedMask is not None:
+            arguments["fixed_mask"] = fixedMask
+        if movingMask is not None:
+            arguments["moving_mask"] = movingMask
+        return arguments
+
+    def safeTransformParameterObject(self, resultTransformParameters, movingImagePath, mapNames=None):
+        # saves the computed registration parameter file. mapNames names the maps of a template registration, whose
+        # shape correction (templateShape) sorts first. A shape map left over from an earlier template is removed
+        mapNames = mapNames or self.registrationTypeList
         nParameterMaps = resultTransformParameters.GetNumberOfParameterMaps()
         folderPath = "transformationMatrices"
         self.util.ensureFolderExists(folderPath)
         imageName = os.path.basename(movingImagePath)
         imageName = imageName.split(".")[0]
 
+        fileNames = [imageName + "_" + mapNames[index] + ".txt" for index in range(nParameterMaps)]
+        for fileName in os.listdir(folderPath):
+            if fileName.startswith(imageName + "_") and "templateShape" in fileName and fileName not in fileNames:
+                os.remove(os.path.join(folderPath, fileName))
+
         for index in range(nParameterMaps):       
-            fileName = imageName + "_" + self.registrationTypeList[index] + ".txt"
+            fileName = fileNames[index]
             finalPath = os.path.join(folderPath, fileName)
             parameterMap = resultTransformParameters.GetParameterMap(index)
 
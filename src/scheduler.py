@@ -0,0 +1,175 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from utils import Utils
+from registration import Registration
+from transformCache import TransformCache
+from catalog import DatasetCatalog
+from profiling import profiler
+
+
+def registerSubject(parameterFolder, fixedImagePath, movingImagePath, numberOfThreads, storeTransforms, cacheFolder, staged, maskPaths, initialMaps, profile):
+    # worker entry point: registers one moving image inside a pool process. initialMaps (one map per stage) warm-starts
+    # the registration, only the stages after them are run. Returns the transform as plain maps and the profiling records of the worker
+    if profile and not profiler.enabled:
+        profiler.enable()
+    profiler.records = []
+    cache = None if cacheFolder is None else TransformCache(cacheFolder)
+    reg = Registration(parameterFolder, cache, staged)
+    initialTransformParameters = reg.util.parameterObjectFromMaps(initialMaps) if initialMaps else None
+    resultTransformParameters = reg.register(fixedImagePath, movingImagePath, numberOfThreads, storeTransforms, initialTransformParameters, len(initialMaps or ()),
+                                             fixedMaskPath=maskPaths[0], movingMaskPath=maskPaths[1])
+    return reg.util.parameterObjectToMaps(resultTransformParameters), profiler.records
+
+
+class RegistrationScheduler:
+
+    def __init__(self, parameterFolder, numberOfWorkers=None, threadsPerWorker=None, maxRetries=1, storeTransforms=True, cacheFolder=None, staged=False, maskFolder=None):
+        cpuCount = os.cpu_count() or 1
+        self.parameterFolder = parameterFolder
+        self.numberOfWorkers = numberOfWorkers or cpuCount
+        self.threadsPerWorker = threadsPerWorker or max(1, cpuCount // self.numberOfWorkers)
+        self.maxRetries = maxRetries
+        self.storeTransforms = storeTransforms
+        self.cacheFolder = cacheFolder
+        self.staged = staged
+        self.maskCatalog = None if maskFolder is None else DatasetCatalog(folders={"mask": maskFolder}) # brain masks (or label maps) passed to elastix
+        self.initialTransforms = {}
+        self.completed = {}
+        self.failed = {}
+
+    ######################################################
+    ### Scheduling #######################################
+    ######################################################
+
+    def run(self, fixedImagePath, movingImagePaths, initialTransforms=None):
+        # registers all moving images in parallel. Returns {movingImagePath: transform parameter maps},
+        # failures are kept in self.failed. initialTransforms {movingImagePath: maps of the first stages} warm-starts subjects
+        self.initialTransforms = initialTransforms or {}
+        self.completed = {}
+        self.failed = {}
+        self.total = len(movingImagePaths)
+        self.startTime = time.perf_counter()
+
+        # at most numberOfWorkers subjects are in flight, so a crashed pool only loses those, the queued ones go back
+        # into a new full pool unharmed. The lost ones are spread over the queue, so they are not in flight together
+        # again. Subjects that were in flight during more than one crash are suspects, they are rerun each in its own
+        # single worker pool, several at a time
+        crashes = dict.fromkeys(movingImagePaths, 0)
+        pending = list(movingImagePaths)
+        suspects = []
+        while pending:
+            lost, queued = self.runPool(fixedImagePath, pending, self.numberOfWorkers)
+            for movingImagePath in lost:
+                crashes[movingImagePath] += 1
+            pending = self.interleave(queued, [movingImagePath for movingImagePath in lost if crashes[movingImagePath] == 1], self.numberOfWorkers)
+            suspects += [movingImagePath for movingImagePath in lost if crashes[movingImagePath] > 1]
+        self.runIsolated(fixedImagePath, suspects)
+
+        if self.failed:
+            print(f"{len(self.failed)} of {self.total} registrations failed: {sorted(self.failed)}")
+        return self.completed
+
+    def runPool(self, fixedImagePath, movingImagePaths, numberOfWorkers, isolated=False):
+        # runs the registrations in one process pool, one subject per worker at a time. Returns the subjects that were
+        # in flight when the pool crashed and the ones that were still queued
+        attempts = dict.fromkeys(movingImagePaths, 0)
+        queue = list(movingImagePaths)
+        brokenSubjects = []
+        broken = False
+        context = multiprocessing.get_context("spawn") # itk is not fork safe
+
+        with ProcessPoolExecutor(max_workers=numberOfWorkers, mp_context=context) as executor:
+            futures = {}
+            while True:
+                while queue and not broken and len(futures) < numberOfWorkers:
+                    try:
+                        futures[self.submit(executor, fixedImagePath, queue[0])] = queue[0]
+                    except BrokenProcessPool:
+                        broken = True
+                        break
+                    queue.pop(0)
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    movingImagePath = futures.pop(future)
+                    try:
+                        self.completed[movingImagePath], records = future.result()
+                        profiler.records.extend(records)
+                    except BrokenProcessPool:
+                        broken = True
+                        if isolated:
+                            self.failed[movingImagePath] = "worker process crashed"
+                            self.reportProgress(movingImagePath)
+                        else:
+                            brokenSubjects.append(movingImagePath)
+                        continue
+                    except Exception as e:
+                        attempts[movingImagePath] += 1
+                        if attempts[movingImagePath] <= self.maxRetries:
+                            print(f"Retrying {movingImagePath} ({attempts[movingImagePath]}/{self.maxRetries}): {str(e)}")
+                            queue.insert(0, movingImagePath)
+                            continue
+                        self.failed[movingImagePath] = str(e)
+                    self.reportProgress(movingImagePath)
+        return brokenSubjects, queue
+
+    @staticmethod
+    def interleave(queue, subjects, spacing):
+        # inserts the subjects into the queue, spacing queued subjects apart
+        queue = list(queue)
+        for index, subject in enumerate(subjects):
+            queue.insert(min(index * (spacing + 1), len(queue)), subject)
+        return queue
+
+    def runIsolated(self, fixedImagePath, movingImagePaths):
+        # one pool per subject, so a crash only loses its own subject. numberOfWorkers of them run concurrently
+        with ThreadPoolExecutor(self.numberOfWorkers) as threads:
+            list(threads.map(lambda movingImagePath: self.runPool(fixedImagePath, [movingImagePath], 1, isolated=True), movingImagePaths))
+
+    def submit(self, executor, fixedImagePath, movingImagePath):
+        # submits a single registration to the pool
+        maskPaths = (self.maskPath(fixedImagePath), self.maskPath(movingImagePath))
+        return executor.submit(registerSubject, self.parameterFolder, fixedImagePath, movingImagePath, self.threadsPerWorker, self.storeTransforms,
+                               self.cacheFolder, self.staged, maskPaths, self.initialTransforms.get(movingImagePath), profiler.enabled)
+
+    def maskPath(self, imagePath):
+        if self.maskCatalog is None:
+            return None
+        return self.maskCatalog.path("mask", Utils.subjectId(imagePath))
+
+    ######################################################
+    ### Progress #########################################
+    ######################################################
+
+    def reportProgress(self, movingImagePath):
+        # prints the progress and the estimated time until all registrations are finished
+        finished = len(self.completed) + len(self.failed)
+        elapsed = time.perf_counter() - self.startTime
+        remaining = elapsed / finished * (self.total - finished)
+        status = "failed" if movingImagePath in self.failed else "registered"
+        print(f"[{finished}/{self.total}] {os.path.basename(movingImagePath)} {status} - "
+              f"elapsed {self.formatDuration(elapsed)}, ETA {self.formatDuration(remaining)}")
+
+    @staticmethod
+    def formatDuration(seconds):
+        # formats seconds as h:mm:ss
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+if __name__ == "__main__":
+    from utils import Utils
+    util = Utils()
+
+    imagePaths = util.getAllFiles("training-set/training-images")
+    fixedImagePath, movingImagePaths = util.splitFixedFromMoving(imagePaths, "1010")
+
+    scheduler = RegistrationScheduler("Par0038", numberOfWorkers=4)
+    scheduler.run(fixedImagePath, movingImagePaths)
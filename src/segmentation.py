@@ -0,0 +1,134 @@
+import os
+import itk # itk-elastix
+import numpy as np
+
+from utils import Utils
+from registration import Registration
+from atlasFormats import AtlasReader
+from tissueModels import TissueModel
+
+
+class AtlasSegmentation:
+    # segments new scans with the outputs of Atlas and TissueModels. The mean image is registered to the scan,
+    # the atlas priors are warped with the result and combined with the tissue model voxel-wise (Bayes rule),
+    # optionally refined with EM. Atlas, mean image, tissue model and parameter maps are loaded once and
+    # reused for every scan, so a batch only pays registration plus classification per subject
+    util = Utils()
+
+    def __init__(self, parameterFolder, atlasPath="atlas.nii.gz", meanImagePath="meanImage.nii.gz", tissueModelPath="TissueModel.csv", emIterations=0):
+        self.registration = Registration(parameterFolder)
+        self.meanImage = self.util.loadImageFrom(meanImagePath)
+        self.priorImages = self.loadPriors(atlasPath)
+        self.tissueModel = self.loadTissueModel(tissueModelPath)
+        self.emIterations = emIterations
+
+    ######################################################
+    ### Loading ##########################################
+    ######################################################
+
+    def loadPriors(self, atlasPath):
+        # one itk image per tissue in the space of the mean image (the atlas is stored transposed, see Atlas.storeAtlas).
+        # Dense, quantized and sparse atlases are read one label at a time
+        atlas = AtlasReader(atlasPath)
+        priorImages = []
+        for label in range(1, atlas.numberOfLabels + 1):
+            priorImage = itk.GetImageFromArray(np.ascontiguousarray(atlas.probability(label).T))
+            priorImage.CopyInformation(self.meanImage)
+            priorImages.append(priorImage)
+        return priorImages
+
+    @staticmethod
+    def loadTissueModel(tissueModelPath):
+        # p(tissue|intensity) lookup table, from TissueModel.csv or TissueModel.npz
+        return TissueModel.load(tissueModelPath)
+
+    ######################################################
+    ### Segmentation #####################################
+    ######################################################
+
+    def segmentAll(self, imagePaths, outputFolder="segmentations", maskPaths=None, numberOfThreads=None):
+        # segments all images with the preloaded atlas. Returns the paths of the label maps
+        maskPaths = maskPaths or [None] * len(imagePaths)
+        self.util.ensureFolderExists(outputFolder)
+        outputPaths = []
+        for imagePath, maskPath in zip(imagePaths, maskPaths):
+            outputPath = os.path.join(outputFolder, os.path.basename(imagePath).split(".")[0] + "_seg.nii.gz")
+            outputPaths.append(self.segmentToFile(imagePath, outputPath, maskPath, numberOfThreads))
+        return outputPaths
+
+    def segmentToFile(self, imagePath, outputPath, maskPath=None, numberOfThreads=None):
+        itk.imwrite(self.segment(imagePath, maskPath, numberOfThreads), outputPath)
+        return outputPath
+
+    def segment(self, imagePath, maskPath=None, numberOfThreads=None):
+        # returns the label map (0 = background) of a scan as itk image in the space of the scan
+        image = self.util.loadImageFrom(imagePath)
+        priors = self.warpPriors(image, numberOfThreads)
+        imageArray = itk.GetArrayViewFromImage(image)
+        if maskPath is None:
+            mask = priors.sum(axis=0) > 0.5 # brain region of the atlas
+        else:
+            mask = itk.GetArrayViewFromImage(self.util.loadImageFrom(maskPath)) > 0
+
+        labels = np.zeros(imageArray.shape, dtype=np.uint8)
+        labels[mask] = self.classify(imageArray[mask], priors[:, mask].T)
+        labelImage = itk.GetImageFromArray(labels)
+        labelImage.CopyInformation(image)
+        return labelImage
+
+    def propagate(self, imagePath, labelPath, numberOfThreads=None):
+        # registers a scan to the mean image and propagates its label map (nearest neighbour) into atlas space
+        transformParameterObject = self.registration.registerImages(self.meanImage, self.util.loadImageFrom(imagePath), numberOfThreads)
+        self.util.setNearestNeighbourInterpolation(transformParameterObject)
+        return itk.transformix_filter(self.util.loadImageFrom(labelPath), transform_parameter_object=transformParameterObject)
+
+    def propagateToFile(self, imagePath, labelPath, outputPath, numberOfThreads=None):
+        # stores the propagated label map as integer labels (transformix returns float), uint8 up to 255 labels
+        propagatedLabelMap = self.propagate(imagePath, labelPath, numberOfThreads)
+        labelArray = np.rint(itk.GetArrayViewFromImage(propagatedLabelMap))
+        dtype = np.uint8 if labelArray.max(initial=0) <= np.iinfo(np.uint8).max else np.uint16
+        labelMapImage = itk.GetImageFromArray(labelArray.astype(dtype))
+        labelMapImage.CopyInformation(propagatedLabelMap)
+        itk.imwrite(labelMapImage, outputPath)
+        return outputPath
+
+    def warpPriors(self, image, numberOfThreads=None):
+        # registers the mean image to the scan and warps the priors (linear interpolation keeps them in [0, 1])
+        transformParameterObject = self.registration.registerImages(image, self.meanImage, numberOfThreads)
+        self.util.setInterpolationOrder(transformParameterObject, 1)
+        priors = [itk.GetArrayFromImage(itk.transformix_filter(priorImage, transform_parameter_object=transformParameterObject))
+                  for priorImage in self.priorImages]
+        return np.stack(priors)
+
+    def classify(self, intensities, priors):
+        # intensities: brain voxels (M,), priors: M x numberOfLabels. Returns labels 1..numberOfLabels
+        likelihoods = self.tissueModel.lookupTable[self.intensityIndex(intensities)].astype(np.float64)
+        posteriors = likelihoods * priors
+        for _ in range(self.emIterations):
+            posteriors = self.expectationMaximization(intensities, priors, posteriors)
+        noEvidence = posteriors.sum(axis=1) == 0
+        posteriors[noEvidence] = priors[noEvidence] # intensities the tissue model has never seen
+        return (np.argmax(posteriors, axis=1) + 1).astype(np.uint8)
+
+    def intensityIndex(self, intensities):
+        # 8-bit intensity bin of every voxel, normalized like the training data of TissueModels
+        return TissueModel.intensityBins(intensities, *TissueModel.intensityRange(intensities))
+
+    @staticmethod
+    def expectationMaximization(intensities, priors, posteriors):
+        # one EM step of a Gaussian mixture whose mixing weights are the atlas priors
+        responsibilities = posteriors / np.maximum(posteriors.sum(axis=1, keepdims=True), 1e-12)
+        weights = np.maximum(responsibilities.sum(axis=0), 1e-12)
+        means = responsibilities.T @ intensities / weights
+        variances = (responsibilities * np.square(intensities[:, np.newaxis] - means)).sum(axis=0) / weights
+        variances = np.maximum(variances, 1e-6)
+        likelihoods = np.exp(-np.square(intensities[:, np.newaxis] - means) / (2 * variances)) / np.sqrt(2 * np.pi * variances)
+        return likelihoods * priors
+
+
+if __name__ == "__main__":
+    util = Utils()
+
+    imagePaths = util.getAllFiles("test-set/testing-images")
+    segmentation = AtlasSegmentation("Par0038", emIterations=5)
+    segmentation.segmentAll(imagePaths)
@@ -0,0 +1,161 @@
+import json
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def initWorker(segmentationArguments):
+    # loads the atlas, tissue model and parameter objects once per worker process
+    global segmentation
+    from segmentation import AtlasSegmentation
+    segmentation = AtlasSegmentation(**segmentationArguments)
+
+
+def runJob(kind, arguments, numberOfThreads):
+    # worker entry point, runs one request with the resident AtlasSegmentation
+    if kind == "warmup":
+        return None
+    if kind == "segment":
+        return segmentation.segmentToFile(arguments["image"], arguments["output"], arguments.get("mask"), numberOfThreads)
+    if kind == "propagate":
+        return segmentation.propagateToFile(arguments["image"], arguments["label"], arguments["output"], numberOfThreads)
+    raise ValueError(f"Unknown request {kind}")
+
+
+class SegmentationService:
+    # local HTTP daemon that keeps warm AtlasSegmentation workers. Requests wait in a bounded queue,
+    # when it is full new requests are rejected with 503 instead of piling up (backpressure)
+    kinds = ("segment", "propagate")
+
+    def __init__(self, parameterFolder, atlasPath="atlas.nii.gz", meanImagePath="meanImage.nii.gz", tissueModelPath="TissueModel.csv",
+                 numberOfWorkers=2, queueSize=8, threadsPerWorker=None, emIterations=0):
+        self.segmentationArguments = {"parameterFolder": parameterFolder, "atlasPath": atlasPath, "meanImagePath": meanImagePath,
+                                      "tissueModelPath": tissueModelPath, "emIterations": emIterations}
+        self.numberOfWorkers = numberOfWorkers
+        self.threadsPerWorker = threadsPerWorker
+        self.slots = threading.BoundedSemaphore(numberOfWorkers + queueSize) # running plus waiting requests
+        self.lock = threading.Lock()
+        self.state = "starting" # ok, restarting or broken (the last restart failed, the next request retries)
+        self.restarts = 0
+        self.executor = self.startPool()
+        self.state = "ok"
+
+    def startPool(self):
+        # starts the workers and loads them before the first request arrives
+        context = multiprocessing.get_context("spawn") # itk is not fork safe
+        executor = ProcessPoolExecutor(self.numberOfWorkers, mp_context=context, initializer=initWorker, initargs=(self.segmentationArguments,))
+        for future in [executor.submit(runJob, "warmup", None, None) for _ in range(self.numberOfWorkers)]:
+            future.result()
+        return executor
+
+    def restartPool(self, brokenExecutor):
+        # a worker died (e.g. elastix crashed on a bad scan) and took the pool with it. A new pool is warmed up in the
+        # background, meanwhile requests are answered with 503
+        with self.lock:
+            if brokenExecutor is not self.executor or self.state == "restarting":
+                return
+            self.state = "restarting"
+        brokenExecutor.shutdown(wait=False)
+        threading.Thread(target=self.replacePool, daemon=True).start()
+
+    def replacePool(self):
+        try:
+            executor = self.startPool()
+        except Exception as e:
+            print(f"Restarting the worker pool failed: {str(e)}")
+            with self.lock:
+                self.state = "broken"
+            return
+        with self.lock:
+            self.executor = executor
+            self.state = "ok"
+            self.restarts += 1
+
+    def submit(self, kind, arguments):
+        # queues a request, raises queue.Full if the service is saturated and BrokenProcessPool while the pool restarts
+        if not self.slots.acquire(blocking=False):
+            raise queue.Full
+        with self.lock:
+            executor, state = self.executor, self.state
+        try:
+            if state == "restarting":
+                raise BrokenProcessPool("the worker pool is restarting")
+            future = executor.submit(runJob, kind, arguments, self.threadsPerWorker)
+        except BrokenProcessPool:
+            self.slots.release()
+            self.restartPool(executor)
+            raise
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.jobDone(executor, future))
+        return future
+
+    def jobDone(self, executor, future):
+        self.slots.release()
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self.restartPool(executor)
+
+    def health(self):
+        with self.lock:
+            return {"status": self.state, "workers": self.numberOfWorkers, "restarts": self.restarts}
+
+    def serve(self, host="127.0.0.1", port=8750):
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+        server.service = self
+        print(f"Serving on http://{host}:{port}")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.executor.shutdown()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # POST /segment {"image", "output", "mask"(optional)} and POST /propagate {"image", "label", "output"}.
+    # The response is sent when the result is written: {"output": path}
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.respond(404, {"error": "not found"})
+        health = self.server.service.health()
+        self.respond(200 if health["status"] == "ok" else 503, health)
+
+    def do_POST(self):
+        kind = self.path.strip("/")
+        if kind not in SegmentationService.kinds:
+            return self.respond(404, {"error": "not found"})
+        try:
+            arguments = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            future = self.server.service.submit(kind, arguments)
+        except queue.Full:
+            return self.respond(503, {"error": "queue full, retry later"}, {"Retry-After": "5"})
+        except BrokenProcessPool:
+            return self.respond(503, {"error": "worker pool is restarting, retry later"}, {"Retry-After": "30"})
+        except ValueError as e:
+            return self.respond(400, {"error": str(e)})
+
+        try:
+            self.respond(200, {"output": future.result()})
+        except BrokenProcessPool:
+            self.respond(500, {"error": "a worker process crashed, the pool is restarting"})
+        except Exception as e:
+            self.respond(500, {"error": str(e)})
+
+    def respond(self, status, body, headers=None):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+if __name__ == "__main__":
+    service = SegmentationService("Par0038", numberOfWorkers=2, queueSize=8)
+    service.serve()
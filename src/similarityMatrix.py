@@ -0,0 +1,150 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+
+def jointHistogramRow(row):
+    # worker entry point: mutual information of image `row` with all later images
+    quantized, numberOfBins = workerData["quantized"], workerData["numberOfBins"]
+    values = []
+    for other in range(row + 1, quantized.shape[0]):
+        jointIndex = quantized[row].astype(np.int32) * numberOfBins + quantized[other]
+        jointHistogram = np.bincount(jointIndex, minlength=numberOfBins * numberOfBins)
+        values.append(SimilarityMatrix.mutualInformation(jointHistogram.reshape(numberOfBins, numberOfBins)))
+    return row, values
+
+
+def initWorker(quantized, numberOfBins):
+    global workerData
+    workerData = {"quantized": quantized, "numberOfBins": numberOfBins}
+
+
+class SimilarityMatrix:
+    # computes the full N x N similarity matrix of N images at once. MSE and NCC are computed from the
+    # Gram matrix, accumulated over blocks of voxels; mutual information from joint histograms on worker processes
+    metrics = ("mse", "ncc", "mi")
+
+    def __init__(self, metric="mse", downsample=1, mask=None, blockSize=1 << 18, numberOfBins=32, numberOfWorkers=None):
+        if metric not in self.metrics:
+            raise ValueError(f"Unknown metric {metric}, choose one of {self.metrics}")
+        self.metric = metric
+        self.downsample = downsample
+        self.mask = mask
+        self.blockSize = blockSize
+        self.numberOfBins = numberOfBins
+        self.numberOfWorkers = numberOfWorkers or os.cpu_count() or 1
+
+    def compute(self, images):
+        # images: list of arrays with the same shape. The compared voxels are gathered from the images block by block,
+        # so no N x voxels copy of the images is made
+        if self.metric == "mse":
+            return self.meanSquaredErrorMatrix(images)
+        if self.metric == "ncc":
+            return self.normalizedCrossCorrelationMatrix(images)
+        return self.mutualInformationMatrix(images)
+
+    def selectReference(self, matrix):
+        # index of the image most similar to all others (the diagonal is ignored)
+        offDiagonal = ~np.eye(matrix.shape[0], dtype=bool)
+        meanSimilarity = np.where(offDiagonal, matrix, 0).sum(axis=1) / max(matrix.shape[0] - 1, 1)
+        return int(np.argmin(meanSimilarity) if self.metric == "mse" else np.argmax(meanSimilarity))
+
+    def voxelSelection(self, shape):
+        # flat indices (into the full resolution images) of the downsampled, masked voxels, None for all voxels
+        if self.downsample == 1 and self.mask is None:
+            return None
+        step = (slice(None, None, self.downsample),) * len(shape)
+        selection = np.arange(np.prod(shape)).reshape(shape)[step]
+        if self.mask is not None:
+            selection = selection[np.asarray(self.mask, dtype=bool)[step]]
+        return selection.ravel()
+
+    def blocks(self, images):
+        # yields (start, N x blockSize float64 block) over the compared voxels
+        flatImages = [np.asarray(image).reshape(-1) for image in images] # views of contiguous arrays
+        selection = self.voxelSelection(np.shape(images[0]))
+        numberOfVoxels = flatImages[0].size if selection is None else selection.size
+        for start in range(0, numberOfVoxels, self.blockSize):
+            voxels = slice(start, start + self.blockSize) if selection is None else selection[start:start + self.blockSize]
+            yield start, np.stack([image[voxels] for image in flatImages]).astype(np.float64)
+
+    def numberOfVoxels(self, images):
+        selection = self.voxelSelection(np.shape(images[0]))
+        return np.asarray(images[0]).size if selection is None else selection.size
+
+    ######################################################
+    ### Gram Matrix Metrics ##############################
+    ######################################################
+
+    def gramMatrix(self, images, offsets=None):
+        # X X^T accumulated in float64 over blocks of voxels (optionally of X - offsets)
+        gram = np.zeros((len(images), len(images)))
+        for _, block in self.blocks(images):
+            if offsets is not None:
+                block -= offsets[:, np.newaxis]
+            gram += block @ block.T
+        return gram
+
+    def meanSquaredErrorMatrix(self, images):
+        # mean((a - b)^2) = (|a|^2 + |b|^2 - 2 a.b) / V
+        gram = self.gramMatrix(images)
+        squaredNorms = np.diag(gram)
+        matrix = (squaredNorms[:, np.newaxis] + squaredNorms[np.newaxis, :] - 2 * gram) / self.numberOfVoxels(images)
+        np.fill_diagonal(matrix, 0)
+        return np.maximum(matrix, 0) # rounding can make values slightly negative
+
+    def normalizedCrossCorrelationMatrix(self, images):
+        # covariance of the centered images divided by their standard deviations
+        sums = np.zeros(len(images))
+        for _, block in self.blocks(images):
+            sums += block.sum(axis=1)
+        gram = self.gramMatrix(images, offsets=sums / self.numberOfVoxels(images))
+        norms = np.sqrt(np.diag(gram))
+        norms[norms == 0] = 1 # constant images
+        return gram / np.outer(norms, norms)
+
+    ######################################################
+    ### Mutual Information ###############################
+    ######################################################
+
+    def mutualInformationMatrix(self, images):
+        quantized = self.quantize(images)
+        numberOfImages = quantized.shape[0]
+        matrix = np.zeros((numberOfImages, numberOfImages))
+        for index in range(numberOfImages):
+            histogram = np.bincount(quantized[index], minlength=self.numberOfBins)
+            matrix[index, index] = self.entropy(histogram)
+
+        with ProcessPoolExecutor(self.numberOfWorkers, initializer=initWorker, initargs=(quantized, self.numberOfBins)) as executor:
+            for row, values in executor.map(jointHistogramRow, range(numberOfImages - 1)):
+                matrix[row, row + 1:] = values
+                matrix[row + 1:, row] = values
+        return matrix
+
+    def quantize(self, images):
+        # maps each image linearly to numberOfBins intensity bins, as N x voxels matrix of 8 (or 16) bit bins
+        minimum = np.full(len(images), np.inf)
+        maximum = np.full(len(images), -np.inf)
+        for _, block in self.blocks(images):
+            minimum = np.minimum(minimum, block.min(axis=1))
+            maximum = np.maximum(maximum, block.max(axis=1))
+        span = maximum - minimum
+        span[span == 0] = 1
+
+        dtype = np.uint8 if self.numberOfBins <= 256 else np.uint16
+        quantized = np.empty((len(images), self.numberOfVoxels(images)), dtype=dtype)
+        for start, block in self.blocks(images):
+            bins = (block - minimum[:, np.newaxis]) / span[:, np.newaxis] * (self.numberOfBins - 1)
+            quantized[:, start:start + block.shape[1]] = np.rint(bins)
+        return quantized
+
+    @staticmethod
+    def entropy(histogram):
+        probabilities = histogram[histogram > 0] / histogram.sum()
+        return -np.sum(probabilities * np.log(probabilities))
+
+    @staticmethod
+    def mutualInformation(jointHistogram):
+        # I(A;B) = H(A) + H(B) - H(A,B)
+        return (SimilarityMatrix.entropy(jointHistogram.sum(axis=1)) + SimilarityMatrix.entropy(jointHistogram.sum(axis=0))
+                - SimilarityMatrix.entropy(jointHistogram.ravel()))
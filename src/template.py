@@ -0,0 +1,196 @@
+import os
+import time
+import itk # itk-elastix
+import numpy as np
+
+from utils import Utils
+from scheduler import RegistrationScheduler
+from accumulator import RunningAccumulator
+from registration import Registration
+from profiling import profiler
+
+
+class TemplateBuilder:
+    # groupwise template: all subjects are registered to the current template in parallel, resampled and averaged
+    # into the next template, which starts from a single reference image. The average is then resampled with the
+    # inverse of the mean linear (rigid and affine) transform of the subjects, so the template moves to the mean pose
+    # and size of the group instead of keeping those of the reference (the deformable part is not corrected).
+    # From the second iteration on every subject reuses its first reuseStages stages (default: all but the last,
+    # i.e. rigid and affine) of the previous iteration and only re-estimates the remaining ones. Iterations stop once
+    # the template changes by less than tolerance (relative RMS) or the next iteration would not finish within timeLimit seconds
+    util = Utils()
+    linearTransforms = ("EulerTransform", "AffineTransform", "TranslationTransform")
+
+    def __init__(self, imagePaths, parameterFolder, templateFolder="template", maxIterations=5, tolerance=1e-3, reuseStages=None,
+                 numberOfWorkers=None, threadsPerWorker=None, maxRetries=1, maskFolder=None, timeLimit=None):
+        self.imagePaths = list(imagePaths)
+        self.parameterFolder = parameterFolder
+        self.templateFolder = templateFolder
+        self.maxIterations = maxIterations
+        self.tolerance = tolerance
+        self.registration = Registration(parameterFolder)
+        numberOfStages = len(self.registration.registrationTypeList)
+        self.reuseStages = max(numberOfStages - 1, 0) if reuseStages is None else min(reuseStages, numberOfStages)
+        self.scheduler = RegistrationScheduler(parameterFolder, numberOfWorkers, threadsPerWorker, maxRetries, storeTransforms=False, maskFolder=maskFolder)
+        self.timeLimit = timeLimit
+        self.history = [] # relative change of the template per iteration
+
+    def build(self, referenceImagePath=None):
+        # returns the path of the final template. The transforms of all subjects to it are stored in transformationMatrices,
+        # so Atlas can propagate the labels into template space
+        templatePath = referenceImagePath or self.imagePaths[0]
+        previousTemplate = itk.GetArrayFromImage(self.util.loadImageFrom(templatePath))
+        transforms = {}
+        correction = None
+        startTime = time.perf_counter()
+        self.history = []
+
+        for iteration in range(1, self.maxIterations + 1):
+            iterationStart = time.perf_counter()
+            with profiler.stage("template iteration", iteration=iteration) as record:
+                warmStarts = self.warmStarts(transforms, correction)
+                transforms = self.scheduler.run(templatePath, self.imagePaths, warmStarts)
+                template = self.averageImages(templatePath, transforms)
+                correction, record["affineDrift"] = self.shapeCorrection(transforms)
+                if correction is not None:
+                    template = itk.transformix_filter(template, transform_parameter_object=self.util.parameterObjectFromMaps([correction]))
+                templatePath = self.storeTemplate(template, iteration)
+                change = self.relativeChange(previousTemplate, itk.GetArrayViewFromImage(template))
+                record["change"] = change
+            self.history.append(change)
+            previousTemplate = itk.GetArrayFromImage(template)
+            print(f"Template iteration {iteration}: {len(transforms)} subjects, relative change {change:.2e}")
+
+            if change < self.tolerance:
+                break
+            iterationTime = time.perf_counter() - iterationStart
+            if self.timeLimit is not None and time.perf_counter() - startTime + iterationTime > self.timeLimit:
+                print("Stopping, the next iteration would exceed the time limit")
+                break
+
+        mapNames = self.registration.registrationTypeList
+        if correction is not None:
+            transforms = {path: [correction] + maps for path, maps in transforms.items()} # from the corrected template
+            mapNames = ["templateShape"] + mapNames # sorts before every stage
+        self.storeTransforms(transforms, mapNames)
+        return templatePath
+
+    def warmStarts(self, transforms, correction):
+        # the first reuseStages maps of every subject. The correction moved the template, so it is folded into the last
+        # reused map, which works when that map is affine and the ones before are linear. Otherwise all stages are re-estimated
+        if self.reuseStages == 0 or not transforms:
+            return {}
+        warmStarts = {path: maps[:self.reuseStages] for path, maps in transforms.items()}
+        if correction is None:
+            return warmStarts
+        for maps in warmStarts.values():
+            if maps[-1]["Transform"][0] != "AffineTransform" or any(parameterMap["Transform"][0] not in self.linearTransforms for parameterMap in maps):
+                return {}
+            before = self.composedMatrix(maps[:-1])
+            maps[-1] = self.affineMap(self.composedMatrix(maps) @ self.linearMatrix(correction) @ np.linalg.inv(before), maps[-1])
+        return warmStarts
+
+    ######################################################
+    ### Shape correction #################################
+    ######################################################
+
+    def shapeCorrection(self, transforms):
+        # returns the affine map of the inverse mean linear transform (template grid) and how far the mean is from the
+        # identity (largest absolute entry of the difference). None without any linear stage
+        matrices, referenceMap = [], None
+        for maps in transforms.values():
+            linearMaps = [parameterMap for parameterMap in maps if parameterMap["Transform"][0] in self.linearTransforms]
+            if not linearMaps:
+                return None, 0.0
+            referenceMap = linearMaps[0]
+            matrices.append(self.composedMatrix(linearMaps))
+        if not matrices:
+            return None, 0.0
+        meanMatrix = np.mean(matrices, axis=0)
+        drift = float(np.abs(meanMatrix - np.eye(4)).max())
+        return self.affineMap(np.linalg.inv(meanMatrix), referenceMap), drift
+
+    @classmethod
+    def composedMatrix(cls, parameterMaps):
+        # elastix composes the maps of a chain, the first one is applied first
+        matrix = np.eye(4)
+        for parameterMap in parameterMaps:
+            matrix = cls.linearMatrix(parameterMap) @ matrix
+        return matrix
+
+    @staticmethod
+    def linearMatrix(parameterMap):
+        # homogeneous 4x4 matrix of an elastix Euler, affine or translation map in physical coordinates:
+        # x -> R (x - c) + t + c with the rotation centre c
+        transform = parameterMap["Transform"][0]
+        parameters = np.array(parameterMap["TransformParameters"], dtype=np.float64)
+        center = np.array(parameterMap.get("CenterOfRotationPoint", ("0", "0", "0")), dtype=np.float64)
+        if transform == "TranslationTransform":
+            rotation, translation = np.eye(3), parameters
+        elif transform == "AffineTransform":
+            rotation, translation = parameters[:9].reshape(3, 3), parameters[9:]
+        elif transform == "EulerTransform":
+            (cx, cy, cz), (sx, sy, sz) = np.cos(parameters[:3]), np.sin(parameters[:3])
+            rotationX = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+            rotationY = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+            rotationZ = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+            computeZYX = parameterMap.get("ComputeZYX", ("false",))[0] == "true"
+            rotation = rotationZ @ rotationY @ rotationX if computeZYX else rotationZ @ rotationX @ rotationY
+            translation = parameters[3:]
+        else:
+            raise ValueError(f"{transform} is not a linear transform")
+        matrix = np.eye(4)
+        matrix[:3, :3] = rotation
+        matrix[:3, 3] = translation + center - rotation @ center
+        return matrix
+
+    @staticmethod
+    def affineMap(matrix, referenceMap):
+        # elastix affine map of a homogeneous matrix, with the grid and rotation centre of referenceMap
+        center = np.array(referenceMap.get("CenterOfRotationPoint", ("0", "0", "0")), dtype=np.float64)
+        translation = matrix[:3, 3] - center + matrix[:3, :3] @ center
+        parameterMap = {key: value for key, value in referenceMap.items() if key != "ComputeZYX"}
+        parameterMap.update({"Transform": ("AffineTransform",), "NumberOfParameters": ("12",),
+                             "TransformParameters": tuple(repr(float(value)) for value in [*matrix[:3, :3].ravel(), *translation]),
+                             "CenterOfRotationPoint": tuple(repr(float(value)) for value in center)})
+        return parameterMap
+
+    def averageImages(self, templatePath, transforms):
+        # resamples every registered subject into the template grid and returns the mean as itk image
+        templateImage = self.util.loadImageFrom(templatePath)
+        accumulator = RunningAccumulator(np.float64)
+        for imagePath, maps in transforms.items():
+            with profiler.stage("template resample", os.path.basename(imagePath).split(".")[0]):
+                transformParameterObject = self.util.parameterObjectFromMaps(maps)
+                resampledImage = itk.transformix_filter(self.util.loadImageFrom(imagePath), transform_parameter_object=transformParameterObject)
+                accumulator.add(itk.GetArrayViewFromImage(resampledImage))
+        if accumulator.count == 0:
+            raise RuntimeError("No subject could be registered to the template")
+        template = itk.GetImageFromArray(accumulator.mean().astype(np.float32))
+        template.CopyInformation(templateImage)
+        return template
+
+    def storeTemplate(self, template, iteration):
+        self.util.ensureFolderExists(self.templateFolder)
+        templatePath = os.path.join(self.templateFolder, f"template_{iteration}.nii.gz")
+        itk.imwrite(template, templatePath)
+        return templatePath
+
+    @staticmethod
+    def relativeChange(previousTemplate, template):
+        # RMS difference relative to the RMS intensity of the previous template
+        previousTemplate = np.asarray(previousTemplate, dtype=np.float64)
+        difference = np.sqrt(np.mean(np.square(np.asarray(template, dtype=np.float64) - previousTemplate)))
+        return float(difference / max(np.sqrt(np.mean(np.square(previousTemplate))), 1e-12))
+
+    def storeTransforms(self, transforms, mapNames=None):
+        for imagePath, maps in transforms.items():
+            self.registration.safeTransformParameterObject(self.util.parameterObjectFromMaps(maps), imagePath, mapNames)
+
+
+if __name__ == "__main__":
+    util = Utils()
+
+    imagePaths = util.getAllFiles("training-set/training-images")
+    builder = TemplateBuilder(imagePaths, "Par0038", maxIterations=4)
+    builder.build()
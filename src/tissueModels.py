@@ -1,91 +1,189 @@
 import os
 import numpy as np
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from utils import Utils
-from scipy.ndimage import gaussian_filter
-import pandas as pd
+from profiling import profiler
+# scipy is imported where it is needed, the figures are rendered by qcReport.py
 
 
 
+def subjectHistograms(imagePath, maskPath, numberOfLabels):
+    # worker entry point: intensity histograms (numberOfLabels x 256) of one subject
+    util = Utils()
+    image, _ = util.readNiftiImage(imagePath)
+    mask, _ = util.readNiftiImage(maskPath)
+    minVal, maxVal = TissueModel.intensityRange(image[mask > 0])
+
+    labels = np.rint(mask).astype(np.int64)
+    inLabels = (labels >= 1) & (labels <= numberOfLabels)
+    intensities = TissueModel.intensityBins(image[inLabels], minVal, maxVal)
+    binIndex = (labels[inLabels] - 1) * 256 + intensities
+    return np.bincount(binIndex, minlength=numberOfLabels * 256).reshape(numberOfLabels, 256)
+
+
+class TissueModel:
+    # p(tissue | intensity) as lookup table over the 8-bit intensity bins of TissueModels, loaded once from
+    # TissueModel.csv or the binary TissueModel.npz (or .npy). Volumes are normalized exactly like the training data:
+    # min-max over the brain voxels (and 0, the masked background of training) to 0..255, truncated to uint8
+    util = Utils()
+    defaultLabels = ("CSF", "WM", "GM")
+
+    def __init__(self, probabilities, labels=defaultLabels):
+        # probabilities: bins (255) x numberOfLabels. The table gets a 256th row so uint8 bins index it directly,
+        # intensity 255 shares the last bin as in the training histograms
+        self.probabilities = np.asarray(probabilities, dtype=np.float32)
+        self.labels = list(labels)
+        self.numberOfLabels = self.probabilities.shape[1]
+        rows = np.minimum(np.arange(256), len(self.probabilities) - 1)
+        self.lookupTable = self.probabilities[rows]
+
+    @classmethod
+    def load(cls, path):
+        if path.endswith(".npz"):
+            with np.load(path) as arrays:
+                return cls(arrays["probabilities"], [str(label) for label in arrays["labels"]])
+        if path.endswith(".npy"):
+            return cls(np.load(path))
+        with open(path) as file:
+            labels = file.readline().strip().split(",")
+        return cls(np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2), labels)
+
+    def store(self, path):
+        # .npz stores the table in binary, anything else as CSV with one column per tissue
+        if path.endswith(".npz"):
+            np.savez(path, probabilities=self.probabilities, labels=np.array(self.labels))
+        else:
+            np.savetxt(path, self.probabilities, fmt="%.9g", delimiter=",", header=",".join(self.labels), comments="")
+        return path
+
+    ######################################################
+    ### Normalization ####################################
+    ######################################################
+
+    @staticmethod
+    def intensityRange(intensities):
+        # normalization range of the brain intensities, the background of the masked training images is 0
+        if intensities.size == 0:
+            return 0.0, 0.0
+        return float(min(intensities.min(), 0)), float(max(intensities.max(), 0))
+
+    @staticmethod
+    def intensityBins(intensities, minVal, maxVal):
+        # 8-bit intensity (0..255) of every voxel
+        scale = 255 / (maxVal - minVal) if maxVal > minVal else 0
+        bins = np.subtract(intensities, minVal, dtype=np.float64) # native integer dtypes would overflow
+        bins *= scale
+        np.clip(bins, 0, 255, out=bins)
+        return bins.astype(np.uint8)
+
+    ######################################################
+    ### Classification ###################################
+    ######################################################
+
+    def posterior(self, volume, mask=None):
+        # p(tissue | intensity) of every voxel, volume.shape + (numberOfLabels,). Voxels outside the mask are 0,
+        # any nonzero mask value (bool, integer or float mask) counts as inside
+        volume = np.asarray(volume)
+        mask = None if mask is None else np.asarray(mask) > 0
+        minVal, maxVal = self.intensityRange(volume if mask is None else volume[mask])
+        posteriors = self.lookupTable[self.intensityBins(volume, minVal, maxVal)]
+        if mask is not None:
+            posteriors[~mask] = 0
+        return posteriors
+
+    def classify(self, volume, mask=None):
+        # most probable tissue (1..numberOfLabels) per voxel, 0 outside the mask
+        mask = None if mask is None else np.asarray(mask) > 0
+        labels = (np.argmax(self.posterior(volume, mask), axis=-1) + 1).astype(np.uint8)
+        if mask is not None:
+            labels[~mask] = 0
+        return labels
+
+    def classifyFile(self, imagePath, maskPath=None, outputPath=None):
+        # without a mask all nonzero voxels (skull stripped scans) are classified. Returns outputPath or the label map
+        import nibabel as nib
+        image, affine = self.util.readNiftiImage(imagePath)
+        mask = image != 0 if maskPath is None else self.util.readNiftiImage(maskPath)[0] > 0
+        labels = self.classify(image, mask)
+        if outputPath is None:
+            return labels
+        nib.Nifti1Image(labels, affine).to_filename(outputPath)
+        return outputPath
+
+    def classifyAll(self, imagePaths, maskPaths=None, outputFolder="tissueLabels", numberOfWorkers=None):
+        # classifies many scans on worker processes, the table is sent once per scan (a few KB).
+        # Returns the paths of the label maps
+        self.util.ensureFolderExists(outputFolder)
+        maskPaths = maskPaths or [None] * len(imagePaths)
+        outputPaths = [os.path.join(outputFolder, self.util.subjectId(imagePath) + "_tissues.nii.gz") for imagePath in imagePaths]
+        with profiler.stage("tissue classification", subjects=len(imagePaths)), ProcessPoolExecutor(numberOfWorkers) as executor:
+            return list(executor.map(self.classifyFile, imagePaths, maskPaths, outputPaths))
+
+
 class TissueModels:
     util = Utils()
 
-    def __init__(self, imageFolder, maskFolder):
+    def __init__(self, imageFolder, maskFolder, numberOfWorkers=None):
         self.imagePaths = self.util.getAllFiles(imageFolder)
         self.maskPaths = self.util.getAllFiles(maskFolder)
         self.numberOfLabels = 3
+        self.numberOfWorkers = numberOfWorkers
 
-    def execute(self):
-        # calculates and stores a TissueModel, masking and normalizing each image between 0 and 255
-        vecIntensitiesDistributions = self.computeVecIntensityDistribtions()
+    def execute(self, histogramPath="qc/tissueHistograms.npz"):
+        # calculates and stores a TissueModel, masking and normalizing each image between 0 and 255.
+        # The histograms are stored for the QC report (qcReport.py) instead of being plotted here, None skips them
+        intensityHistograms = self.computeIntensityHistograms()
 
-        # Compute and plot histograms
-        histograms, edgesList = self.computeDistribution(vecIntensitiesDistributions, normalize=True)
+        histograms, edgesList = self.computeDistribution(intensityHistograms, normalize=True)
         histograms_probabilities = self.normalizeHistogramsList(histograms)
 
-        self.plotDistributionsNorm(histograms, edgesList, name_axisy='p(X)',name_plot="Distribution_Norm.jpeg")
-        self.plotHistogramProbabilities(histograms_probabilities,edgesList, name_axisy='p(X|Tissue)', name_plot="ProbabilityHistogram.jpeg")
         self.storeTissueModel(histograms_probabilities)
+        if histogramPath is None:
+            return
 
-        histograms_distribution, edgesList = self.computeDistribution(vecIntensitiesDistributions, normalize=False)
-        self.plotDistributions(histograms_distribution, edgesList,name_axisy='Pixel Count',name_plot="Distribution.jpeg")
-        
+        histograms_distribution, edgesList = self.computeDistribution(intensityHistograms, normalize=False)
+        self.storeHistograms(histogramPath, histograms, histograms_probabilities, histograms_distribution, edgesList[0])
 
     ######################################################
     ### Masking, Normalizing and Concatenating ###########
     ######################################################
 
-    def computeVecIntensityDistribtions(self):
-        # adds all pixels to the list of the corresponding label (multiple labels possible)
+    def computeIntensityHistograms(self):
+        # counts the 8-bit intensities of every label per subject on worker processes and merges the counts.
+        # Returns a numberOfLabels x 256 array, the raw intensities are never collected
         pairs = self.matchMasksToImages()
-
-        vecIntensitiesDistributions= [[] for _ in range(self.numberOfLabels)]
-        for imagePath, maskPath in pairs:
-            image, _ = self.util.readNiftiImage(imagePath)
-            mask, _ = self.util.readNiftiImage(maskPath)
-            maskedImage = np.where(mask > 0, image, 0)
-            normalizedImage = self.normalizeImage(maskedImage)
-
-            for label in range(self.numberOfLabels):
-                vecIntensitiesDistributions[label].extend(normalizedImage[mask==label+1] )
-        return vecIntensitiesDistributions
+        intensityHistograms = np.zeros((self.numberOfLabels, 256), dtype=np.int64)
+        with profiler.stage("tissue histograms", subjects=len(pairs)), ProcessPoolExecutor(self.numberOfWorkers) as executor:
+            imagePaths, maskPaths = zip(*pairs)
+            for histograms in executor.map(subjectHistograms, imagePaths, maskPaths, [self.numberOfLabels] * len(pairs)):
+                intensityHistograms += histograms
+        return intensityHistograms
 
     def matchMasksToImages(self):
-        # matches mask to image
+        # matches mask to image by exact subject id, one pass over each list
+        masksBySubject = {}
+        for maskPath in sorted(self.maskPaths):
+            masksBySubject.setdefault(self.util.subjectId(maskPath), maskPath)
         matches = []
         for imagePath in self.imagePaths:
-            baseName = os.path.basename(imagePath).split('.')[0]
-            expectedMaskName = f"{baseName}"
-
-            for maskPath in self.maskPaths:
-                if expectedMaskName in maskPath:
-                    matches.append((imagePath,maskPath ))
-                    break  
+            maskPath = masksBySubject.get(self.util.subjectId(imagePath))
+            if maskPath is not None:
+                matches.append((imagePath, maskPath))
         return matches
 
-    @staticmethod
-    def normalizeImage(vec, newMin=0, newMax=255):
-        # min max normalization
-        minVal = np.min(vec)
-        maxVal = np.max(vec)
-        normalized = (vec - minVal) / (maxVal - minVal) * (newMax - newMin) + newMin
-        return normalized
-
-
     ######################################################
     ### Compute Histograms ###############################
     ######################################################
 
-    def computeDistribution(self, vecIntensitiesDistributions,normalize=False):
+    def computeDistribution(self, intensityHistograms, normalize=False):
+        # intensityHistograms: per label counts of the 8-bit intensities 0..255
+        from scipy.ndimage import gaussian_filter
         histograms = []
         edgesList = []  
-        for channel_data in vecIntensitiesDistributions:
-            data_array = np.array(channel_data).reshape(-1, 1)
-            data_array = data_array.astype(np.uint8)  # For 8-bit
-
-            # Compute histogram
-            hist, edges = np.histogram(data_array, bins=255, range=(0, 255))
-            hist = hist.astype(np.float64)
+        edges = np.linspace(0, 255, 256) # edges of np.histogram(bins=255, range=(0, 255))
+        for counts in intensityHistograms:
+            hist = counts[:255].astype(np.float64)
+            hist[-1] += counts[255] # the last bin of np.histogram includes its right edge
             if normalize:
                 hist/=np.sum(hist)
 
@@ -106,81 +204,20 @@ class TissueModels:
 
     
     ######################################################
-    ### Plot Histograms ##################################
+    ### Store ############################################
     ######################################################
 
-    def plotHistogramProbabilities(self, histograms, edgesList, name_axisy, name_plot):
-        colors = ['red', 'green', 'blue']  
-        labels = ['CSF', 'WM', 'GM']  
-        plt.figure(figsize=(10, 5))
-
-        for i, (hist, edges) in enumerate(zip(histograms, edgesList)):
-            plt.plot(edges[:-1], hist, color=colors[i], label=labels[i])
-
-        plt.title('Intensity Tissue Probabilities')
-        plt.xlabel('Pixel Intensity')
-        plt.ylabel(name_axisy)
-        plt.legend(loc='upper right')
-        plt.xlim([0, 255])
-        plt.grid(True, which='both', linestyle='--', linewidth=0.5)
-        plt.tight_layout()
-        plt.savefig(f"images/{name_plot}",dpi=600)
-        plt.show()
-
-    def plotDistributionsNorm(self, histograms, edgesList, name_axisy, name_plot):
-        colors = ['red', 'green', 'blue'] 
-        labels = ['CSF', 'WM', 'GM']  
-        plt.figure(figsize=(10, 5))
-
-        for i, (hist, edges) in enumerate(zip(histograms, edgesList)):
-            plt.plot(edges[:-1], hist, color=colors[i], label=labels[i])
-
-        plt.title('Probability Density Function of Each Tissue')
-        plt.xlabel('Pixel Intensity')
-        plt.ylabel(name_axisy)
-        plt.legend(loc='upper right')
-        plt.xlim([0, 255])
-        plt.grid(True, which='both', linestyle='--', linewidth=0.5)
-        plt.tight_layout()
-        plt.savefig(f"images/{name_plot}",dpi=600)
-        plt.show()
-
-    def plotDistributions(self, histograms, edgesList, name_axisy, name_plot):
-        colors = ['red', 'green', 'blue']  
-        labels = ['CSF', 'WM', 'GM']  
-
-        fig, main_ax = plt.subplots(figsize=(10, 5))
-
-        for i, (hist, edges) in enumerate(zip(histograms, edgesList)):
-            main_ax.plot(edges[:-1], hist, color=colors[i], label=labels[i])
-
-        main_ax.set_title('Histograms of Tissue Intensities')
-        main_ax.set_xlabel('Pixel Intensity')
-        main_ax.set_ylabel(name_axisy)
-        main_ax.legend(loc='upper right')
-        main_ax.set_xlim([0, 255])
-        main_ax.grid(True, which='both', linestyle='--', linewidth=0.5)
-
-        # zoom region
-        x1, x2, y1, y2 = 0, 100, 0, 5000
-        axins = main_ax.inset_axes([0.07, 0.7, 0.2, 0.2]) 
-        for i, (hist, edges) in enumerate(zip(histograms, edgesList)):
-            axins.plot(edges[:-1], hist, color=colors[i])
-
-        axins.set_xlim(x1, x2)
-        axins.set_ylim(y1, y2)
-
-        main_ax.indicate_inset_zoom(axins)
-
-        plt.tight_layout()
-        plt.savefig(f"images/{name_plot}",dpi=600)  
-        plt.show()
-
-    @staticmethod
-    def storeTissueModel(histograms_distribution):
-        df = pd.DataFrame(histograms_distribution).T 
-        df.columns = ['CSF', 'WM', 'GM']
-        df.to_csv('TissueModel.csv', index=False)
+    def storeHistograms(self, histogramPath, histograms, histograms_probabilities, histograms_distribution, edges):
+        # the curves of the QC figures, one row per tissue
+        self.util.ensureFolderExists(os.path.dirname(histogramPath) or ".")
+        np.savez(histogramPath, distributionNorm=np.stack(histograms), probabilities=np.stack(histograms_probabilities),
+                 distribution=np.stack(histograms_distribution), edges=edges, labels=np.array(TissueModel.defaultLabels[:self.numberOfLabels]))
+
+    def storeTissueModel(self, histograms_distribution):
+        # TissueModel.csv for reading, TissueModel.npz for loading
+        tissueModel = TissueModel(np.stack(histograms_distribution, axis=1), TissueModel.defaultLabels[:self.numberOfLabels])
+        tissueModel.store("TissueModel.csv")
+        tissueModel.store("TissueModel.npz")
 
 
     
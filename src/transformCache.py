@@ -0,0 +1,114 @@
+import os
+import shutil
+import hashlib
+import itk # itk-elastix
+
+from utils import Utils
+
+
+class TransformCache:
+    # content-addressed cache for registration results. Every stage (rigid, affine, bspline) gets its own
+    # entry, keyed by the hashes of the fixed image, the moving image and the parameter files up to and
+    # including that stage. Changing a later parameter file therefore leaves the entries of earlier stages valid.
+    # Entries are evicted least recently used first once the cache grows beyond maxBytes.
+    util = Utils()
+
+    def __init__(self, cacheFolder="transformCache", maxBytes=1 << 30):
+        self.cacheFolder = cacheFolder
+        self.maxBytes = maxBytes
+        self.fileHashes = {} # (path, size, mtime) -> hash, avoids rehashing unchanged files
+
+    ######################################################
+    ### Keys #############################################
+    ######################################################
+
+    def stageKeys(self, fixedImagePath, movingImagePath, parameterPaths, maskPaths=(None, None)):
+        # returns one key per stage, each one covering the images, the masks and all parameter files up to that stage
+        digest = hashlib.sha256()
+        digest.update(self.hashFile(fixedImagePath).encode())
+        digest.update(self.hashFile(movingImagePath).encode())
+        for maskName, maskPath in zip(("fixed mask", "moving mask"), maskPaths):
+            if maskPath is not None: # unmasked registrations keep their keys
+                digest.update(maskName.encode() + self.hashFile(maskPath).encode())
+
+        keys = []
+        for parameterPath in parameterPaths:
+            digest.update(self.hashFile(parameterPath).encode())
+            keys.append(digest.copy().hexdigest())
+        return keys
+
+    def hashFile(self, filePath):
+        stat = os.stat(filePath)
+        fileKey = (os.path.abspath(filePath), stat.st_size, stat.st_mtime_ns)
+        if fileKey not in self.fileHashes:
+            self.fileHashes[fileKey] = self.util.hashFile(filePath)
+        return self.fileHashes[fileKey]
+
+    ######################################################
+    ### Lookup ###########################################
+    ######################################################
+
+    def entryPath(self, key):
+        return os.path.join(self.cacheFolder, key, "transform.txt")
+
+    def cachedStages(self, keys):
+        # number of leading stages that are in the cache
+        numberOfStages = 0
+        for key in keys:
+            if not os.path.exists(self.entryPath(key)):
+                break
+            numberOfStages += 1
+        return numberOfStages
+
+    def get(self, keys):
+        # returns the parameter object of the cached stages, None if not all stages are cached
+        if self.cachedStages(keys) < len(keys):
+            return None
+        parameterObject = itk.ParameterObject.New()
+        try:
+            for key in keys:
+                parameterObject.AddParameterFile(self.entryPath(key))
+                os.utime(os.path.join(self.cacheFolder, key)) # marks the entry as recently used
+        except (FileNotFoundError, RuntimeError):
+            return None # evicted by another process in the meantime
+        return parameterObject
+
+    def put(self, keys, parameterObject, firstStage=0):
+        # stores the parameter maps of parameterObject as the stages firstStage, firstStage + 1, ...
+        for index in range(parameterObject.GetNumberOfParameterMaps()):
+            key = keys[firstStage + index]
+            entryFolder = os.path.join(self.cacheFolder, key)
+            if os.path.exists(entryFolder):
+                continue
+            temporaryFolder = f"{entryFolder}.{os.getpid()}.tmp"
+            self.util.ensureFolderExists(temporaryFolder)
+            parameterObject.WriteParameterFile(parameterObject.GetParameterMap(index), os.path.join(temporaryFolder, "transform.txt"))
+            try:
+                os.rename(temporaryFolder, entryFolder) # atomic, concurrent workers never see half written entries
+            except OSError:
+                shutil.rmtree(temporaryFolder, ignore_errors=True) # written by another worker
+        self.evict()
+
+    ######################################################
+    ### Eviction #########################################
+    ######################################################
+
+    def evict(self):
+        # removes the least recently used entries until the cache fits into maxBytes
+        entries = []
+        for key in os.listdir(self.cacheFolder):
+            entryFolder = os.path.join(self.cacheFolder, key)
+            if key.endswith(".tmp") or not os.path.isdir(entryFolder):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(entryFolder))
+                entries.append((os.stat(entryFolder).st_mtime, size, entryFolder))
+            except FileNotFoundError:
+                continue
+
+        totalBytes = sum(size for _, size, _ in entries)
+        for _, size, entryFolder in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            shutil.rmtree(entryFolder, ignore_errors=True)
+            totalBytes -= size
@@ -1,23 +1,131 @@
-import itk
 import os
-import nibabel as nib
+import hashlib
+import numpy as np
+# itk and nibabel are imported where they are needed, itk alone takes seconds to load
+
+
 class Utils:
+    openVolumeStore = None
+
     def __init__self(self):
         pass
 
     @staticmethod
     def loadImageFrom(imagePath):
         # Load images with itk floats (itk.F). Necessary for elastix
+        volumeStore = Utils.getVolumeStore()
+        if volumeStore is not None and Utils.isNifti(imagePath):
+            return volumeStore.itkImage(imagePath)
+        import itk # itk-elastix
         return itk.imread(imagePath, itk.F)
 
+    @staticmethod
+    def useVolumeStore(storeFolder):
+        # serves all nifti reads from a VolumeStore. Set through the environment, so worker processes inherit it
+        os.environ["VOLUME_STORE"] = storeFolder
+
+    @staticmethod
+    def getVolumeStore():
+        # the VolumeStore set with useVolumeStore, None if volumes are read directly
+        storeFolder = os.environ.get("VOLUME_STORE")
+        if storeFolder is None:
+            return None
+        if Utils.openVolumeStore is None or Utils.openVolumeStore.storeFolder != storeFolder:
+            from volumeStore import VolumeStore # volumeStore imports utils
+            Utils.openVolumeStore = VolumeStore(storeFolder)
+        return Utils.openVolumeStore
+
+    @staticmethod
+    def isNifti(filePath):
+        return filePath.endswith(".nii") or filePath.endswith(".nii.gz")
+
+    @staticmethod
+    def readLabelMap(labelPath):
+        # integer label map as array in itk (z, y, x) order in its stored dtype, without the float conversion of loadImageFrom
+        volumeStore = Utils.getVolumeStore()
+        if volumeStore is not None and Utils.isNifti(labelPath):
+            return volumeStore.array(labelPath).T
+        import itk # itk-elastix
+        return itk.GetArrayFromImage(itk.imread(labelPath))
+
+    @staticmethod
+    def loadMaskFrom(maskPath):
+        # binary brain mask (every label > 0) as unsigned char image, the mask type elastix expects
+        import itk # itk-elastix
+        labelImage = Utils.loadImageFrom(maskPath)
+        maskImage = itk.GetImageFromArray((itk.GetArrayViewFromImage(labelImage) > 0).astype(np.uint8))
+        maskImage.CopyInformation(labelImage)
+        return maskImage
+
+    @staticmethod
+    def findMaskPath(imagePath, maskFolder):
+        # the mask (or label map) of an image in maskFolder, named <id>.nii.gz or <id>_<suffix>, None if there is none
+        if maskFolder is None:
+            return None
+        subject = Utils.subjectId(imagePath)
+        for fileName in sorted(os.listdir(maskFolder)):
+            if Utils.subjectId(fileName) == subject:
+                return os.path.join(maskFolder, fileName)
+        return None
+
+    @staticmethod
+    def boundingBox(mask, margin=0):
+        # slices of the smallest box holding all nonzero voxels of mask, grown by margin voxels on each side
+        region = []
+        for axis in range(mask.ndim):
+            otherAxes = tuple(index for index in range(mask.ndim) if index != axis)
+            nonzero = np.flatnonzero(np.any(mask, axis=otherAxes))
+            if nonzero.size == 0:
+                raise ValueError("The mask is empty")
+            region.append(slice(max(int(nonzero[0]) - margin, 0), min(int(nonzero[-1]) + 1 + margin, mask.shape[axis])))
+        return tuple(region)
+
+    @staticmethod
+    def uncrop(array, region, shape, fillValue=0):
+        # pads a cropped array back to shape, the inverse of array[region]
+        fullArray = np.full(tuple(shape) + array.shape[len(region):], fillValue, dtype=array.dtype)
+        fullArray[region] = array
+        return fullArray
+
     @staticmethod
     def loadTransformParameterObject(filePaths):
         # initializes 
+        import itk # itk-elastix
         parameterObject = itk.ParameterObject.New()
         for parameterPath in filePaths:
             parameterObject.AddParameterFile(parameterPath)
         return parameterObject
 
+    @staticmethod
+    def parameterObjectToMaps(parameterObject):
+        # converts a parameter object to plain dictionaries, which can be passed between processes
+        parameterMaps = []
+        for index in range(parameterObject.GetNumberOfParameterMaps()):
+            parameterMap = parameterObject.GetParameterMap(index)
+            parameterMaps.append({key: tuple(parameterMap[key]) for key in parameterMap.keys()})
+        return parameterMaps
+
+    @staticmethod
+    def parameterObjectFromMaps(parameterMaps):
+        # inverse of parameterObjectToMaps
+        import itk # itk-elastix
+        parameterObject = itk.ParameterObject.New()
+        for parameterMap in parameterMaps:
+            parameterObject.AddParameterMap(parameterMap)
+        return parameterObject
+
+    @staticmethod
+    def setNearestNeighbourInterpolation(parameterObject):
+        # order 0 is nearest neighbour
+        return Utils.setInterpolationOrder(parameterObject, 0)
+
+    @staticmethod
+    def setInterpolationOrder(parameterObject, order):
+        # the final resampling uses the settings of the last map
+        lastIndex = parameterObject.GetNumberOfParameterMaps() - 1
+        parameterObject.SetParameter(lastIndex, "FinalBSplineInterpolationOrder", str(order))
+        return parameterObject
+
     @staticmethod
     def getAllFiles(folderPath):
         allImagePaths = os.listdir(folderPath)
@@ -34,22 +142,37 @@ class Utils:
 
     @staticmethod
     def getImageIndex(relativePaths, imageName):
-        index = 0
-        for relativePath in relativePaths:
-            if imageName in relativePath:
+        # exact match on the subject id (or the file name), "101" does not match "1010"
+        for index, relativePath in enumerate(relativePaths):
+            if imageName in (Utils.subjectId(relativePath), os.path.basename(relativePath)):
                 return index
-            else:
-                index += 1
         raise ValueError(f"{imageName} not found in {relativePaths}")
 
+    @staticmethod
+    def subjectId(filePath):
+        # subject of a dataset file: 1017.nii.gz, 1017_3C.nii.gz and 1017_rigid.txt all belong to 1017
+        return os.path.basename(filePath).split(".")[0].split("_")[0]
+
     def readNiftiImage(self, filePath):
-        # Read Nifti image
+        # Read Nifti image. From a VolumeStore the data is a memory mapped array in its native dtype
         try:
-            niftiImage = nib.load(filePath).get_fdata()
-            return niftiImage, nib.load(filePath).affine
+            volumeStore = self.getVolumeStore()
+            if volumeStore is not None:
+                return volumeStore.array(filePath), volumeStore.affine(filePath)
+            import nibabel as nib
+            niftiImage = nib.load(filePath)
+            return niftiImage.get_fdata(), niftiImage.affine
         except Exception as e:
             print(f"Error reading NIFTI image from {filePath}: {str(e)}")
 
+    def readNiftiAffine(self, filePath):
+        # Read only the affine of a Nifti image, the voxel data is not decoded
+        volumeStore = self.getVolumeStore()
+        if volumeStore is not None:
+            return volumeStore.affine(filePath)
+        import nibabel as nib
+        return nib.load(filePath).affine
+
     def plot_original_images(self, vec_img, case, counter,  axes, title, slice=20):
         # Loop through each case and its images, and plot them in the subplots
         for j in range(len(vec_img)):  # 3 images per case
@@ -69,8 +192,9 @@ class Utils:
 
     @staticmethod
     def getRegistrationSortKey(filePath, fallbackSortValue = 99):
-        # first sorted by registration type, than by filename
+        # first sorted by registration type, than by filename. The shape correction of a template comes before every stage
         primarySortOrder = {
+            'templateShape': 0,
             'rigid': 1,
             'affine': 2,
             'bspline': 3
@@ -85,6 +209,23 @@ class Utils:
                 break
         return (primarySortValue, secondarySortValue)
 
+    @staticmethod
+    def hashFile(filePath, chunkSize=1 << 20):
+        # sha256 of the file content
+        digest = hashlib.sha256()
+        with open(filePath, "rb") as file:
+            for chunk in iter(lambda: file.read(chunkSize), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def hashFiles(filePaths):
+        # combined sha256 of several files, in the given order
+        digest = hashlib.sha256()
+        for filePath in filePaths:
+            digest.update(Utils.hashFile(filePath).encode())
+        return digest.hexdigest()
+
     @staticmethod
     def ensureFolderExists(folderPath):
         if not os.path.exists(folderPath):
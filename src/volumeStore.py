@@ -0,0 +1,93 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+class VolumeStore:
+    # converts NIfTI volumes once into uncompressed .npy files, which are memory mapped on every later read.
+    # Only the pages that are touched get read, so slicing a region reads just that region.
+    # Arrays keep their native dtype and the nibabel (x, y, z) axis order. They are stored in Fortran order,
+    # so .T is a zero-copy C-contiguous (z, y, x) view as used by itk.
+    # Headers (affine and itk geometry) are cached next to the data and in memory.
+
+    def __init__(self, storeFolder="volumeStore"):
+        self.storeFolder = storeFolder
+        self.headers = {}
+        os.makedirs(storeFolder, exist_ok=True) # workers create the store concurrently
+
+    ######################################################
+    ### Conversion #######################################
+    ######################################################
+
+    def entryPath(self, niftiPath):
+        # one entry per source file, the name keeps the file stem for readability
+        pathHash = hashlib.sha1(os.path.abspath(niftiPath).encode()).hexdigest()[:12]
+        stem = os.path.basename(niftiPath).split(".")[0]
+        return os.path.join(self.storeFolder, f"{stem}-{pathHash}")
+
+    def convert(self, niftiPath):
+        # converts niftiPath unless an up to date entry exists. Returns the header
+        entryPath = self.entryPath(niftiPath)
+        stat = os.stat(niftiPath)
+        header = self.headers.get(entryPath) or self.readHeader(entryPath)
+        if header is not None and header["sourceSize"] == stat.st_size and header["sourceMtime"] == stat.st_mtime_ns:
+            self.headers[entryPath] = header
+            return header
+
+        import nibabel as nib
+        niftiImage = nib.load(niftiPath)
+        data = np.asanyarray(niftiImage.dataobj) # native dtype, no float64 upcast
+        temporaryPath = f"{entryPath}.{os.getpid()}.tmp.npy"
+        np.save(temporaryPath, np.asfortranarray(data))
+        os.replace(temporaryPath, entryPath + ".npy")
+
+        header = self.geometry(niftiImage)
+        header.update({"source": os.path.abspath(niftiPath), "sourceSize": stat.st_size, "sourceMtime": stat.st_mtime_ns,
+                       "shape": list(data.shape), "dtype": str(data.dtype)})
+        temporaryPath = f"{entryPath}.{os.getpid()}.json.tmp" # concurrent converters of the same file each write their own
+        with open(temporaryPath, "w") as file:
+            json.dump(header, file)
+        os.replace(temporaryPath, entryPath + ".json")
+        self.headers[entryPath] = header
+        return header
+
+    @staticmethod
+    def readHeader(entryPath):
+        if not os.path.exists(entryPath + ".json"):
+            return None
+        with open(entryPath + ".json") as file:
+            return json.load(file)
+
+    @staticmethod
+    def geometry(niftiImage):
+        # affine plus the itk geometry (LPS) of a nifti image
+        affine = niftiImage.affine
+        spacing = np.array(niftiImage.header.get_zooms()[:3], dtype=np.float64)
+        rasToLps = np.diag([-1.0, -1.0, 1.0])
+        direction = rasToLps @ (affine[:3, :3] / spacing)
+        origin = rasToLps @ affine[:3, 3]
+        return {"affine": affine.tolist(), "spacing": spacing.tolist(), "origin": origin.tolist(), "direction": direction.tolist()}
+
+    ######################################################
+    ### Access ###########################################
+    ######################################################
+
+    def array(self, niftiPath):
+        # read-only memory mapped array in native dtype and nibabel (x, y, z) order
+        self.convert(niftiPath)
+        return np.load(self.entryPath(niftiPath) + ".npy", mmap_mode="r")
+
+    def affine(self, niftiPath):
+        return np.array(self.convert(niftiPath)["affine"])
+
+    def itkImage(self, niftiPath, dtype=np.float32):
+        # itk image with the geometry of the source, by default as float for elastix
+        import itk # itk-elastix
+        header = self.convert(niftiPath)
+        array = self.array(niftiPath).T # (z, y, x) view, no copy
+        image = itk.GetImageFromArray(np.ascontiguousarray(array, dtype=dtype))
+        image.SetSpacing(header["spacing"])
+        image.SetOrigin(header["origin"])
+        image.SetDirection(itk.GetMatrixFromArray(np.array(header["direction"])))
+        return image